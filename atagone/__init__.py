@@ -0,0 +1,5 @@
+#
+# Atag One local API: protocol (no I/O) and an asyncio client
+#
+from .protocol import ProtocolError, Report
+from .client import AtagOneClient, Gather
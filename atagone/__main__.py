@@ -0,0 +1,121 @@
+#
+# Command line for the Atag One client
+#
+#   python3 -m atagone dump 192.168.1.10
+#   python3 -m atagone stream 192.168.1.10 192.168.1.11 --interval 30
+#   python3 -m atagone bench 192.168.1.10 --requests 200
+#
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+from . import protocol
+from .client import AtagOneClient, Gather
+
+
+def Percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {}
+    pick = lambda percent: samples[min(len(samples) - 1, int(len(samples) * percent / 100.0))]
+    return {'n': len(samples), 'p50': round(pick(50), 2), 'p95': round(pick(95), 2), 'max': round(samples[-1], 2)}
+
+
+async def Pair(clients):
+    # Ask every thermostat to accept our MAC, the user confirms on its display
+    for client in clients:
+        while True:
+            status = await client.Pair()
+            if status == protocol.ACC_OK:
+                break
+            if status != protocol.ACC_PENDING:
+                raise protocol.ProtocolError('%s refused pairing, acc_status %s' % (client.host, status))
+            print('%s: confirm the pairing request on the thermostat' % client.host, file=sys.stderr)
+            await asyncio.sleep(5)
+
+
+async def Dump(clients, args):
+    info = sum(protocol.SECTIONS.values())
+    replies = await Gather(clients, 'Retrieve', info)
+    print(json.dumps(dict([(client.host, reply if isinstance(reply, dict) else {'error': str(reply)})
+                           for (client, reply) in zip(clients, replies)]), indent=1))
+
+
+async def Stream(clients, args):
+    # One JSON line per thermostat per interval
+    count = 0
+    while (args.count == 0) or (count < args.count):
+        started = time.monotonic()
+        for (client, report) in zip(clients, await Gather(clients)):
+            line = {'time': round(time.time(), 3), 'host': client.host}
+            if isinstance(report, protocol.Report):
+                line.update(report.AsDict())
+            else:
+                line['error'] = str(report)
+            print(json.dumps(line), flush=True)
+        count += 1
+        await asyncio.sleep(max(0.0, args.interval - (time.monotonic() - started)))
+
+
+async def Bench(clients, args):
+    async def Run(client):
+        latencies = []
+        errors = 0
+        for request in range(args.requests):
+            started = time.perf_counter()
+            try:
+                await client.Retrieve()
+                latencies.append((time.perf_counter() - started) * 1000)
+            except (OSError, EOFError, asyncio.TimeoutError, protocol.ProtocolError):
+                errors += 1
+        return (latencies, errors)
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*[Run(client) for client in clients])
+    elapsed = time.perf_counter() - started
+    total = sum([len(latencies) for (latencies, errors) in results])
+    summary = {'hosts': dict([(client.host, {'latency_ms': Percentiles(latencies), 'errors': errors, 'connects': client.connects})
+                              for (client, (latencies, errors)) in zip(clients, results)]),
+               'requests_per_s': round(total / elapsed, 1) if elapsed > 0 else None}
+    print(json.dumps(summary, indent=1))
+
+
+async def Main(args):
+    clients = [AtagOneClient(host, args.port, args.mac, timeout=args.timeout) for host in args.hosts]
+    try:
+        if args.pair:
+            await Pair(clients)
+        await COMMANDS[args.command](clients, args)
+    finally:
+        for client in clients:
+            await client.Close()
+
+
+COMMANDS = {'dump': Dump, 'stream': Stream, 'bench': Bench}
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python3 -m atagone', description='Atag One local API client')
+    parser.add_argument('command', choices=sorted(COMMANDS))
+    parser.add_argument('hosts', nargs='+', help='thermostat IP addresses')
+    parser.add_argument('--port', type=int, default=protocol.PORT)
+    parser.add_argument('--mac', default='1a-2b-3c-4d-5e-6f', help='MAC address the thermostat was paired with')
+    parser.add_argument('--pair', action='store_true', help='pair first (confirm on the thermostat)')
+    parser.add_argument('--timeout', type=float, default=10.0)
+    parser.add_argument('--interval', type=float, default=30.0, help='stream: seconds between polls')
+    parser.add_argument('--count', type=int, default=0, help='stream: number of polls, 0 = until interrupted')
+    parser.add_argument('--requests', type=int, default=100, help='bench: retrieves per host')
+    args = parser.parse_args()
+    try:
+        asyncio.run(Main(args))
+    except KeyboardInterrupt:
+        pass
+    except (OSError, protocol.ProtocolError) as error:
+        print('error: %s' % error, file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+#
+# asyncio client for the Atag One local API
+#
+# One kept-alive connection per thermostat; requests on it are sent one at a
+# time, which is all the thermostat's embedded web server handles. Several
+# thermostats are polled concurrently with Gather().
+#
+import asyncio
+
+from . import protocol
+
+
+class AtagOneClient:
+    READ_SIZE = 65536
+
+    def __init__(self, host, port=protocol.PORT, mac='1a-2b-3c-4d-5e-6f', name='Atag One client', timeout=10.0):
+        self.host = host
+        self.port = port
+        self.mac = mac
+        self.name = name
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.lock = None
+        self.assembler = protocol.ResponseAssembler()
+        self.seqnr = 0
+        self.connects = 0
+
+    async def Connect(self):
+        (self.reader, self.writer) = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+        self.assembler.Reset()
+        self.connects += 1
+
+    async def Close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+        self.reader = None
+        self.writer = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exception):
+        await self.Close()
+
+    async def Request(self, path, message):
+        # Returns (reply type, reply); a kept-alive connection the thermostat
+        # dropped in the meantime is reopened once
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            for attempt in (0, 1):
+                reused = self.writer is not None
+                try:
+                    if not reused:
+                        await self.Connect()
+                    self.writer.write(protocol.EncodeRequest(path, message, self.host, self.port))
+                    body = await asyncio.wait_for(self.ReadResponse(), self.timeout)
+                    return protocol.ParseReply(body)
+                except (OSError, EOFError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+                    await self.Close()
+                    if (not reused) or (attempt > 0):
+                        raise
+                except protocol.ProtocolError:
+                    await self.Close()
+                    raise
+
+    async def ReadResponse(self):
+        # Requests are sent one at a time, so there is never more than one response
+        while True:
+            data = await self.reader.read(self.READ_SIZE)
+            if not data:
+                raise EOFError('connection closed by %s' % self.host)
+            responses = self.assembler.Feed(data)
+            if responses:
+                (status, body) = responses[0]
+                if status != 200:
+                    raise protocol.ProtocolError('HTTP status %d' % status)
+                return body
+
+    def Next(self):
+        self.seqnr += 1
+        return self.seqnr
+
+    async def Call(self, path, message, replyType):
+        (answered, reply) = await self.Request(path, message)
+        if answered != replyType:
+            raise protocol.ProtocolError('expected %s, got %s' % (replyType, answered))
+        return reply
+
+    async def Pair(self):
+        # acc_status: ACC_OK once the thermostat accepted this MAC, ACC_PENDING while it waits for the user
+        reply = await self.Call(protocol.PAIR, protocol.PairMessage(self.Next(), self.mac, self.name), 'pair_reply')
+        return protocol.AccStatus(reply)
+
+    async def Retrieve(self, info=protocol.INFO_CONTROL | protocol.INFO_REPORT | protocol.INFO_STATUS):
+        reply = await self.Call(protocol.RETRIEVE, protocol.RetrieveMessage(self.Next(), self.mac, info), 'retrieve_reply')
+        if protocol.AccStatus(reply) != protocol.ACC_OK:
+            raise protocol.ProtocolError('retrieve refused, acc_status %s' % reply.get('acc_status'))
+        return reply
+
+    async def Report(self):
+        return protocol.Report(await self.Retrieve())
+
+    async def Update(self, **control):
+        reply = await self.Call(protocol.UPDATE, protocol.UpdateMessage(self.Next(), self.mac, control), 'update_reply')
+        return protocol.AccStatus(reply)
+
+
+async def Gather(clients, method='Report', *args):
+    # Same call on every client at once; failures come back as the exception
+    return await asyncio.gather(*[getattr(client, method)(*args) for client in clients], return_exceptions=True)
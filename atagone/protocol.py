@@ -0,0 +1,212 @@
+#
+# Atag One local API, without any I/O
+#
+# Builds the JSON messages the thermostat expects on port 10000, frames and
+# parses its replies and parses its discovery broadcasts. Used by the Domoticz plugin (which
+# does its networking through Domoticz.Connection) and by the asyncio client.
+#
+import json
+
+PORT = 10000
+DISCOVERY_PORT = 11000
+
+RETRIEVE = '/retrieve'
+PAIR = '/pair_message'
+UPDATE = '/update'
+
+# Retrieve 'info' bits, one per reply section
+INFO_CONTROL = 1
+INFO_SCHEDULES = 2
+INFO_CONFIGURATION = 4
+INFO_REPORT = 8
+INFO_STATUS = 16
+INFO_WIFISCAN = 32
+INFO_EXTRA = 64
+SECTIONS = { 'control': INFO_CONTROL,
+             'schedules': INFO_SCHEDULES,
+             'configuration': INFO_CONFIGURATION,
+             'report': INFO_REPORT,
+             'status': INFO_STATUS }
+
+# acc_status in every reply
+ACC_ERROR = 0
+ACC_PENDING = 1
+ACC_OK = 2
+ACC_DENIED = 3
+
+REPLY_TYPES = ('retrieve_reply', 'pair_reply', 'update_reply')
+BOILER_CH = 2 # boiler_status bits
+BOILER_DHW = 4
+BOILER_FLAME = 8
+BOILER_BITS = { 'ch_active': BOILER_CH, 'dhw_active': BOILER_DHW, 'flame': BOILER_FLAME }
+USER_AGENT = 'Mozilla/5.0 (compatible; AtagOneLocalAPI/1.0.0; http://atag.one/)'
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def Headers(host, port=PORT):
+    return { 'User-Agent': USER_AGENT,
+             'X-OneApp-Version': '1.0.0',
+             'Content-Type': 'application/json; UTF-8',
+             'Connection': 'keep-alive',
+             'Accept': '*/*',
+             'Accept-Charset': 'UTF-8',
+             'Host': '%s:%s' % (host, port) }
+
+def Auth(mac):
+    return { 'user_account': '', 'mac_address': mac }
+
+def RetrieveMessage(seqnr, mac, info):
+    return { 'retrieve_message': { 'seqnr': seqnr, 'account_auth': Auth(mac), 'info': info } }
+
+def PairMessage(seqnr, mac, name):
+    return { 'pair_message': { 'seqnr': seqnr,
+                               'account_auth': Auth(mac),
+                               'accounts': { 'entries': [{ 'user_account': '',
+                                                           'mac_address': mac,
+                                                           'device_name': name,
+                                                           'account_type': 0 }] } } }
+
+def UpdateMessage(seqnr, mac, control):
+    return { 'update_message': { 'seqnr': seqnr, 'account_auth': Auth(mac), 'control': dict(control) } }
+
+def EncodeRequest(path, message, host, port=PORT):
+    # Complete HTTP/1.1 request, for clients doing their own framing
+    body = json.dumps(message).encode('utf-8')
+    headers = Headers(host, port)
+    headers['Content-Length'] = str(len(body))
+    head = 'POST %s HTTP/1.1\r\n%s\r\n\r\n' % (path, '\r\n'.join(['%s: %s' % (name, headers[name]) for name in headers]))
+    return head.encode('latin-1') + body
+
+def ParseReply(data):
+    # (reply type, reply) from a reply body, ProtocolError for anything else.
+    # json.loads takes the bytes as they came off the socket.
+    try:
+        message = json.loads(data)
+    except ValueError as error:
+        raise ProtocolError('invalid JSON (%s)' % error)
+    if isinstance(message, dict):
+        for replyType in REPLY_TYPES:
+            if isinstance(message.get(replyType), dict):
+                return (replyType, message[replyType])
+    raise ProtocolError('unknown reply')
+
+def AccStatus(reply):
+    try:
+        return int(reply.get('acc_status', -1))
+    except (TypeError, ValueError):
+        return -1
+
+def BoilerBits(status):
+    # boiler_status split into {name: 0/1} for BOILER_BITS
+    status = int(status)
+    return dict([(name, 1 if (status & bit) == bit else 0) for (name, bit) in BOILER_BITS.items()])
+
+
+def ParseAnnouncement(data):
+    # 'ONE <device id> ...' broadcast by the thermostat, None for anything else
+    try:
+        words = bytes(data).decode('ascii').split()
+    except (TypeError, ValueError):
+        return None
+    if (len(words) < 2) or (words[0] != 'ONE'):
+        return None
+    return words[1]
+
+
+class ResponseAssembler:
+    # Incremental HTTP/1.1 response framing by Content-Length. Feed() takes
+    # whatever the socket delivered and returns the complete (status, body)
+    # responses in it, a partial one is kept for the next call. Oversized or
+    # malformed responses raise ProtocolError; framing is lost at that point,
+    # so the caller should drop the connection.
+    MAX_HEAD = 4096
+    MAX_BODY = 65536 # replies are a few kB
+
+    def __init__(self, maxBody=MAX_BODY):
+        self.maxBody = maxBody
+        self.buffer = bytearray()
+        self.status = None # of the response whose body is being collected
+        self.length = 0
+
+    def Reset(self):
+        del self.buffer[:]
+        self.status = None
+
+    def Pending(self):
+        return (len(self.buffer) > 0) or (self.status != None)
+
+    def Feed(self, data):
+        self.buffer += data
+        responses = []
+        while True:
+            if (self.status == None):
+                end = self.buffer.find(b'\r\n\r\n')
+                if (end < 0):
+                    if (len(self.buffer) > self.MAX_HEAD):
+                        self.Fail('HTTP header over %d bytes' % self.MAX_HEAD)
+                    return responses
+                (self.status, self.length) = self.ParseHead(bytes(self.buffer[:end]))
+                del self.buffer[:end + 4]
+            if (len(self.buffer) < self.length):
+                return responses
+            responses.append((self.status, bytes(self.buffer[:self.length])))
+            del self.buffer[:self.length]
+            self.status = None
+
+    def ParseHead(self, head):
+        lines = head.split(b'\r\n')
+        parts = lines[0].split(b' ', 2)
+        if (len(parts) < 2) or (not parts[0].startswith(b'HTTP/')) or (not parts[1].isdigit()):
+            self.Fail('malformed status line %r' % lines[0][:80])
+        length = None
+        for line in lines[1:]:
+            (name, separator, value) = line.partition(b':')
+            name = name.strip().lower()
+            if (name == b'content-length'):
+                length = int(value) if value.strip().isdigit() else -1
+            elif (name == b'transfer-encoding') and (value.strip().lower() != b'identity'):
+                self.Fail('unsupported Transfer-Encoding %r' % value.strip())
+        if (length == None):
+            self.Fail('reply without Content-Length')
+        if (length < 0) or (length > self.maxBody):
+            self.Fail('reply body of %s bytes refused' % length)
+        return (int(parts[1]), length)
+
+    def Fail(self, reason):
+        self.Reset()
+        raise ProtocolError(reason)
+
+
+class Report:
+    # One retrieve reply as plain attributes; fields the thermostat left out are None
+    REPORT = ('room_temp', 'outside_temp', 'burning_hours', 'ch_setpoint', 'dhw_water_temp', 'ch_water_temp',
+              'ch_water_pres', 'ch_return_temp', 'boiler_status')
+    DETAILS = ('rel_mod_level',)
+    CONTROL = ('ch_mode_temp', 'dhw_temp_setp', 'ch_mode', 'ch_status', 'dhw_status', 'vacation_duration')
+    __slots__ = ('seqnr', 'acc_status', 'device_id') + REPORT + DETAILS + CONTROL
+
+    def __init__(self, reply):
+        self.seqnr = reply.get('seqnr')
+        self.acc_status = AccStatus(reply)
+        self.device_id = (reply.get('status') or {}).get('device_id')
+        report = reply.get('report') or {}
+        details = report.get('details') or {}
+        control = reply.get('control') or {}
+        for (names, section) in ((self.REPORT, report), (self.DETAILS, details), (self.CONTROL, control)):
+            for name in names:
+                setattr(self, name, section.get(name))
+
+    @property
+    def flame(self):
+        return None if (self.boiler_status == None) else ((int(self.boiler_status) & BOILER_FLAME) == BOILER_FLAME)
+
+    def AsDict(self):
+        values = dict([(name, getattr(self, name)) for name in self.__slots__])
+        values['flame'] = self.flame
+        return values
+
+    def __repr__(self):
+        return 'Report(%s)' % ', '.join(['%s=%r' % (name, getattr(self, name)) for name in self.__slots__ if getattr(self, name) != None])
@@ -10,10 +10,22 @@
         Forked from code developed by mcorino (https://github.com/mcorino/Domoticz-AtagOne-Local).
         Based on the code developed by Rob Juurlink (https://github.com/kozmoz/atag-one-api).
         Creates a thermostat setpoint sensor and a temperature sensor.
+        Up to 4 thermostats can share one hardware entry, list their IP addresses separated by commas.
     </description>
     <params>
-        <param field="Address" label="IP Address of Atag One" width="200px" required="true" default="127.0.0.1"/>
+        <param field="Address" label="IP Address(es) of Atag One, comma separated" width="300px" required="true" default="127.0.0.1"/>
         <param field="Mode1" label="Domoticz MAC" width="600px" required="true" default="1A-2B-3C-4D-5E-6F"/>
+        <param field="Mode3" label="Setpoint debounce (seconds)" width="75px" required="false" default="2"/>
+        <param field="Mode5" label="Sensors (empty = default, all, or a list like default,flame,rel_mod_level)" width="600px" required="false" default=""/>
+        <param field="Mode6" label="Device writes (e.g. min=60,refresh=600,room_temp=0.2)" width="600px" required="false" default=""/>
+        <param field="Mode4" label="Statistics" width="150px">
+            <options>
+                <option label="Off" value="Off" default="true"/>
+                <option label="Stats file" value="File"/>
+                <option label="Devices" value="Devices"/>
+                <option label="Devices and stats file" value="Both"/>
+            </options>
+        </param>
         <param field="Mode2" label="Debug" width="75px">
             <options>
                 <option label="True" value="Debug"/>
@@ -24,18 +36,64 @@
 </plugin>
 """
 import Domoticz
+import os
 import socket
 import json
+import time
+import random
+import collections
+import array
+from atagone import protocol
+
+# unit: Domoticz unit (None = decode only), section: reply section ('report',
+# 'control', nested as 'report.details'; 'derived' and 'boiler' are computed
+# from decoded values), kind: int or float, scale: multiplier,
+# deadband: smallest change worth a device write (None = write any change at once)
+Field = collections.namedtuple('Field', 'unit section key name device kind scale deadband')
+
+def FormatSchedule(schedule):
+    # Compact text for a Text device, the thermostat's schedule layout is passed through as is
+    text = json.dumps(schedule.get('entries', schedule) if isinstance(schedule, dict) else schedule, separators=(',', ':'))
+    return text if (len(text) <= 255) else text[:252]+'...'
+
+def SwitchState(value):
+    # On/Off switch (nValue, sValue) from a 0/1 control value
+    return (1, 'On') if int(value) else (0, 'Off')
+
+class Selector:
+    # Selector switch levels 0, 10, 20, ... for a control's raw values; as a
+    # Field kind it maps a reply value to the (nValue, sValue) of the nearest level
+    def __init__(self, names, values):
+        self.names = names
+        self.values = values
+
+    def __call__(self, value):
+        index = min(range(len(self.values)), key=lambda index: abs(self.values[index] - float(value)))
+        return (2 if index > 0 else 0, str(index * 10))
+
+    def Value(self, level):
+        index = int(level) // 10
+        return self.values[index] if (0 <= index < len(self.values)) else None
+
+    def Device(self):
+        return {'TypeName': 'Selector Switch', 'Options': {'LevelNames': '|'.join(self.names), 'LevelOffHidden': 'false', 'SelectorStyle': '1'}}
+
+def DeviceValue(value):
+    # Decoded field value to (nValue, sValue), switches and selectors decode to the pair already
+    return value if isinstance(value, tuple) else (0, str(value))
+
+def FormatControl(control):
+    return ', '.join(['%s=%s' % (key, control[key]) for key in sorted(control)])
 
 class BasePlugin:
-    MESSAGE_INFO_CONTROL = 1
-    MESSAGE_INFO_SCHEDULES = 2
-    MESSAGE_INFO_CONFIGURATION = 4
-    MESSAGE_INFO_REPORT = 8
-    MESSAGE_INFO_STATUS = 16
-    MESSAGE_INFO_WIFISCAN = 32
-    MESSAGE_INFO_EXTRA = 64
-    HTTP_CLIENT_PORT = '10000'
+    # Retrieve sections: (info bit, cache TTL in seconds, 0 = fetch every poll)
+    SECTIONS = { 'control': (protocol.INFO_CONTROL, 0),
+                 'report': (protocol.INFO_REPORT, 0),
+                 'status': (protocol.INFO_STATUS, 600),
+                 'configuration': (protocol.INFO_CONFIGURATION, 3600),
+                 'schedules': (protocol.INFO_SCHEDULES, 3600) }
+    HTTP_CLIENT_PORT = str(protocol.PORT)
+    DISCOVERY_PORT = str(protocol.DISCOVERY_PORT) # the thermostat broadcasts 'ONE <device id>' here
     TARGET_TEMP_UNIT = 1
     ROOM_TEMP_UNIT = 2
     OUTSIDE_TEMP_UNIT = 3
@@ -45,373 +103,1327 @@ class BasePlugin:
     CH_WATER_TEMP_UNIT = 7
     CH_WATER_PRES_UNIT = 8
     CH_RETURN_TEMP_UNIT  = 9
+    CH_SCHEDULE_UNIT = 10
+    DUTY_CYCLE_UNIT = 11
+    BURNER_STARTS_UNIT = 12
+    HEATING_RATE_UNIT = 13
+    DELTA_T_UNIT = 14
+    PRESSURE_TREND_UNIT = 15
+    DHW_SETPOINT_UNIT = 16
+    CH_MODE_UNIT = 17
+    CH_ENABLED_UNIT = 18
+    DHW_ENABLED_UNIT = 19
+    VACATION_UNIT = 20
+    FLAME_UNIT = 21
+    CH_ACTIVE_UNIT = 22
+    DHW_ACTIVE_UNIT = 23
+    MODULATION_UNIT = 24
+    STATS_LATENCY_UNIT = 200
+    STATS_PARSE_UNIT = 201
+    STATS_PROCESS_UNIT = 202
+    STATS_BYTES_UNIT = 203
+    STATS_RECONNECTS_UNIT = 204
+    STATS_SKIPPED_UNIT = 205
     TEMPERATURE_MIN = 4.0
     TEMPERATURE_MAX = 27.0
+    DHW_TEMPERATURE_MIN = 40.0 # until the configuration section reports dhw_min_set/dhw_max_set
+    DHW_TEMPERATURE_MAX = 65.0
+    CH_MODES = Selector(('Manual', 'Auto', 'Vacation', 'Extend', 'Fireplace'), (1, 2, 3, 4, 5))
+    VACATIONS = Selector(('Off', '1 day', '2 days', '3 days', '1 week', '2 weeks', '3 weeks', '4 weeks'),
+                         tuple([days * 86400 for days in (0, 1, 2, 3, 7, 14, 21, 28)]))
+    # Writable control fields: (kind, minimum, maximum), all checked in UpdateControl
+    CONTROLS = { 'ch_mode_temp': (float, TEMPERATURE_MIN, TEMPERATURE_MAX),
+                 'dhw_temp_setp': (float, DHW_TEMPERATURE_MIN, DHW_TEMPERATURE_MAX),
+                 'ch_mode': (int, 1, 5),
+                 'ch_status': (int, 0, 1),
+                 'dhw_status': (int, 0, 1),
+                 'vacation_duration': (int, 0, 28 * 86400) }
     FLAME_ON_IMG = 'AtagOneLocalFlame'
     FLAME_OFF_IMG = 'AtagOneLocalNoFlame'
+    # Everything decoded from a retrieve reply, adding a sensor is adding a line.
+    # Fields without a unit are only decoded for the plugin's own use.
+    FIELDS = (
+        Field(TARGET_TEMP_UNIT, 'control', 'ch_mode_temp', 'Room Setpoint', {'Type': 242, 'Subtype': 1, 'Image': FLAME_OFF_IMG}, float, 1, None),
+        Field(ROOM_TEMP_UNIT, 'report', 'room_temp', 'Room Temperature', {'TypeName': 'Temperature'}, float, 1, 0.1),
+        Field(OUTSIDE_TEMP_UNIT, 'report', 'outside_temp', 'Outside Temperature', {'TypeName': 'Temperature'}, float, 1, 0.5),
+        Field(BURNING_HOURS_UNIT, 'report', 'burning_hours', 'Burning Hours', {'Type': 243, 'Subtype': 31}, int, 1, 1),
+        Field(CH_SETPOINT_UNIT, 'report', 'ch_setpoint', 'CH Setpoint', {'Type': 242, 'Subtype': 1, 'Image': FLAME_OFF_IMG}, float, 1, 0.5),
+        Field(DHW_WATER_TEMP_UNIT, 'report', 'dhw_water_temp', 'DHW Water Temperature', {'TypeName': 'Temperature'}, float, 1, 0.5),
+        Field(CH_WATER_TEMP_UNIT, 'report', 'ch_water_temp', 'CH Water Temperature', {'TypeName': 'Temperature'}, float, 1, 0.5),
+        Field(CH_WATER_PRES_UNIT, 'report', 'ch_water_pres', 'CH Water Pressure', {'TypeName': 'Pressure'}, float, 1, 0.05),
+        Field(CH_RETURN_TEMP_UNIT, 'report', 'ch_return_temp', 'CH Return Temperature', {'TypeName': 'Temperature'}, float, 1, 0.5),
+        Field(CH_SCHEDULE_UNIT, 'schedules', 'ch_schedule', 'Heating Schedule', {'TypeName': 'Text'}, FormatSchedule, 1, None),
+        Field(DUTY_CYCLE_UNIT, 'derived', 'duty_cycle', 'Burner Duty Cycle', {'Type': 243, 'Subtype': 31, 'Options': {'Custom': '1;%'}}, float, 1, 2),
+        Field(BURNER_STARTS_UNIT, 'derived', 'starts_per_hour', 'Burner Starts', {'Type': 243, 'Subtype': 31, 'Options': {'Custom': '1;starts/h'}}, float, 1, 0.5),
+        Field(HEATING_RATE_UNIT, 'derived', 'heating_rate', 'Room Heating Rate', {'Type': 243, 'Subtype': 31, 'Options': {'Custom': '1;°C/h'}}, float, 1, 0.1),
+        Field(DELTA_T_UNIT, 'derived', 'delta_t', 'CH Delta T', {'TypeName': 'Temperature'}, float, 1, 0.5),
+        Field(PRESSURE_TREND_UNIT, 'derived', 'pressure_trend', 'CH Pressure Trend', {'Type': 243, 'Subtype': 31, 'Options': {'Custom': '1;bar/day'}}, float, 1, 0.01),
+        Field(DHW_SETPOINT_UNIT, 'control', 'dhw_temp_setp', 'DHW Setpoint', {'Type': 242, 'Subtype': 1, 'Options': {'ValueStep': '1', 'ValueMin': '40', 'ValueMax': '65'}}, float, 1, None),
+        Field(CH_MODE_UNIT, 'control', 'ch_mode', 'Heating Mode', CH_MODES.Device(), CH_MODES, 1, None),
+        Field(CH_ENABLED_UNIT, 'control', 'ch_status', 'Heating Enabled', {'TypeName': 'Switch'}, SwitchState, 1, None),
+        Field(DHW_ENABLED_UNIT, 'control', 'dhw_status', 'Hot Water Enabled', {'TypeName': 'Switch'}, SwitchState, 1, None),
+        Field(VACATION_UNIT, 'control', 'vacation_duration', 'Vacation', VACATIONS.Device(), VACATIONS, 1, None),
+        Field(FLAME_UNIT, 'boiler', 'flame', 'Flame', {'TypeName': 'Switch', 'Image': FLAME_ON_IMG}, SwitchState, 1, None),
+        Field(CH_ACTIVE_UNIT, 'boiler', 'ch_active', 'Heating Active', {'TypeName': 'Switch'}, SwitchState, 1, None),
+        Field(DHW_ACTIVE_UNIT, 'boiler', 'dhw_active', 'Hot Water Active', {'TypeName': 'Switch'}, SwitchState, 1, None),
+        Field(MODULATION_UNIT, 'report.details', 'rel_mod_level', 'Modulation Level', {'TypeName': 'Percentage'}, int, 1, 5),
+        Field(None, 'report', 'boiler_status', None, None, int, 1, None),
+        Field(None, 'configuration', 'dhw_min_set', None, None, float, 1, None),
+        Field(None, 'configuration', 'dhw_max_set', None, None, float, 1, None),
+        Field(None, 'status', 'device_id', None, None, str, 1, None),
+    )
+    COMPUTED_SECTIONS = ('derived', 'boiler')
+    # Devices left out unless named in the Sensors setting (Mode5)
+    OPTIONAL_FIELDS = ('flame', 'ch_active', 'dhw_active', 'rel_mod_level')
+    # Decoded whatever is enabled, polling, pairing and control writes depend on them
+    REQUIRED_FIELDS = ('room_temp', 'ch_mode_temp', 'boiler_status', 'dhw_min_set', 'dhw_max_set', 'device_id')
+    SAMPLE_FIELDS = ('room_temp', 'ch_water_temp', 'ch_return_temp', 'ch_setpoint', 'ch_water_pres', 'boiler_status')
     hostMac = '1a-2b-3c-4d-5e-6f' # 'unique' MAC
     hostName = 'Domoticz Atag One API'
-    hostAuth = True
-    setLevel = False
-    newLevel = None
-    atagConn = None
-    countDown = -1
+    HEARTBEAT_INTERVAL = 10
+    POLL_INTERVAL_FAST = 30 # flame on or right after a setpoint change
+    POLL_INTERVAL_BASE = 60
+    POLL_INTERVAL_MAX = 300 # readings stayed flat for a while
+    RETRY_INTERVAL_MIN = 10
+    RETRY_INTERVAL_MAX = 600
+    SAMPLE_CAPACITY = 1440 # report samples kept, a day at one per minute
+    SAMPLE_WINDOW = 3600 # seconds covered by duty cycle, starts, heating rate and delta-T
+    COMMAND_WINDOW = 2.0 # default, see Mode3
+    REQUEST_TIMEOUT = 15
+    REQUEST_RETRIES = 1
+    STATS_INTERVAL = 300
+    STATS_FILE = 'AtagOneStats.json'
+    SNAPSHOT_FILE = 'AtagOneSnapshot_%s.json' # per hardware ID
+    SNAPSHOT_INTERVAL = 900
+    SNAPSHOT_MAX_AGE = 86400 # older readings are not used to seed new devices
+    DISCOVERY_MAX_AGE = 600 # announcements older than this are not trusted for failover
+    FAILOVER_FAILURES = 2 # failed polls before moving to a discovered address
+    DEVICE_MIN_INTERVAL = 60 # between writes of a sensor with a deadband
+    DEVICE_REFRESH_INTERVAL = 600 # rewrite unchanged sensors so graphs don't flatline
+    UNIT_BLOCK = 50 # thermostat i uses units i*50+1 ... i*50+49
+    MAX_THERMOSTATS = 4 # stats units start at 200
+    discoveryConn = None
+    thermostats = ()
+    wantedSections = ()
+    deviceFields = ()
+    decodeFields = ()
+    derivedFields = ()
+    controlFields = None
+    sampling = False
+    fastHeartbeat = False
+    statsMode = 'Off'
+    nextStats = 0
+    nextSnapshot = 0
+    addresses = None
     
     def __init__(self):
-        #self.var = 123
+        self.stats = PluginStats()
+        self.shadow = ShadowCache(self.DEVICE_MIN_INTERVAL, self.DEVICE_REFRESH_INTERVAL)
         return
 
     def onStart(self):
-        Domoticz.Debug("onStart called")
-        if Parameters["Mode2"] == 'Debug':
-            Domoticz.Debugging(1)
+        log.Debugging(Parameters["Mode2"] == 'Debug')
+        log.Debug("onStart called")
+        if log.debugging:
             DumpConfigToLog()
-        else:
-            Domoticz.Debugging(0)
         self.hostMac = str(Parameters['Mode1'])
         if (self.FLAME_ON_IMG not in Images):
-            Domoticz.Log('Loading flame ON images')
+            log.Log('Loading flame ON images')
             Domoticz.Image('flame-on-icons.zip').Create()
             
         if (self.FLAME_OFF_IMG not in Images):
-            Domoticz.Log('Loading flame OFF images')
+            log.Log('Loading flame OFF images')
             Domoticz.Image('flame-off-icons.zip').Create()
 
         for image in Images:
-            Domoticz.Debug("Icon " + str(Images[image].ID) + " " + Images[image].Name)
+            log.Debug("Icon %s %s", Images[image].ID, Images[image].Name)
 
         #Domoticz.Debug('flame ON image='+str(Images[self.FLAME_ON_IMG].ID))
         #Domoticz.Debug('flame OFF image='+str(Images[self.FLAME_OFF_IMG].ID))
 
-        if (self.TARGET_TEMP_UNIT not in Devices):
-            Domoticz.Device(Name="Room Setpoint",  Unit=self.TARGET_TEMP_UNIT, Type=242, Subtype=1, Image=Images[self.FLAME_OFF_IMG].ID).Create()
-            UpdateDevice(self.TARGET_TEMP_UNIT, 0, "0.0")
-            
-        if (self.ROOM_TEMP_UNIT not in Devices):
-            Domoticz.Device(Name="Room Temperature", Unit=self.ROOM_TEMP_UNIT, TypeName='Temperature').Create()
-            UpdateDevice(self.ROOM_TEMP_UNIT, 0, "0.0")
-            
-        if (self.OUTSIDE_TEMP_UNIT not in Devices):
-            Domoticz.Device(Name="Outside Temperature", Unit=self.OUTSIDE_TEMP_UNIT, TypeName='Temperature').Create()
-            UpdateDevice(self.OUTSIDE_TEMP_UNIT, 0, "0.0")
-            
-        if (self.BURNING_HOURS_UNIT not in Devices):
-            Domoticz.Device(Name="Burning Hours", Unit=self.BURNING_HOURS_UNIT, Type=243, Subtype=31).Create()
-            UpdateDevice(self.BURNING_HOURS_UNIT, 0, "0.0")
-            
-        if (self.CH_SETPOINT_UNIT not in Devices):
-            Domoticz.Device(Name="CH Setpoint", Unit=self.CH_SETPOINT_UNIT, Type=242, Subtype=1, Image=Images[self.FLAME_OFF_IMG].ID).Create()
-            UpdateDevice(self.CH_SETPOINT_UNIT, 0, "0.0")
-            
-        if (self.DHW_WATER_TEMP_UNIT not in Devices):
-            Domoticz.Device(Name="DHW Water Temperature", Unit=self.DHW_WATER_TEMP_UNIT, TypeName='Temperature').Create()
-            UpdateDevice(self.DHW_WATER_TEMP_UNIT, 0, "0.0")
-            
-        if (self.CH_WATER_TEMP_UNIT not in Devices):
-            Domoticz.Device(Name="CH Water Temperature", Unit=self.CH_WATER_TEMP_UNIT, TypeName='Temperature').Create()
-            UpdateDevice(self.CH_WATER_TEMP_UNIT, 0, "0.0")
-            
-        if (self.CH_WATER_PRES_UNIT not in Devices):
-            Domoticz.Device(Name="CH Water Pressure", Unit=self.CH_WATER_PRES_UNIT, TypeName='Pressure').Create()
-            UpdateDevice(self.CH_WATER_PRES_UNIT, 0, "0.0")
-            
-        if (self.CH_RETURN_TEMP_UNIT not in Devices):
-            Domoticz.Device(Name="CH Return Temperature", Unit=self.CH_RETURN_TEMP_UNIT, TypeName='Temperature').Create()
-            UpdateDevice(self.CH_RETURN_TEMP_UNIT, 0, "0.0")
-        
-        self.SetupConnection()
-        Domoticz.Heartbeat(30)
+        self.ParseWriteLimits(Parameters.get("Mode6", ""))
+        self.SelectFields(self.ParseSensors(Parameters.get("Mode5", "")))
+        self.addresses = AddressCache(self.DISCOVERY_MAX_AGE)
+        addresses = [address.strip() for address in Parameters["Address"].split(',') if address.strip() != '']
+        if (len(addresses) > self.MAX_THERMOSTATS):
+            log.Error('Only %d Atag One thermostats are supported, ignoring %s', self.MAX_THERMOSTATS, ', '.join(addresses[self.MAX_THERMOSTATS:]))
+        self.thermostats = [Thermostat(self, index, address, len(addresses) > 1) for (index, address) in enumerate(addresses[:self.MAX_THERMOSTATS])]
+        restored = self.LoadSnapshot()
+
+        self.CreateDevices(restored)
+        self.statsMode = Parameters["Mode4"]
+        if (self.statsMode in ('Devices', 'Both')):
+            self.CreateStatsDevices()
+        self.nextStats = time.monotonic() + self.STATS_INTERVAL
+        self.nextSnapshot = time.monotonic() + self.SNAPSHOT_INTERVAL
+        self.discoveryConn = Domoticz.Connection(Name='AtagOneDiscovery', Transport="UDP/IP", Protocol="None", Port=self.DISCOVERY_PORT)
+        self.discoveryConn.Listen()
+        self.PollDue()
+        Domoticz.Heartbeat(self.HEARTBEAT_INTERVAL)
 
     def onStop(self):
-        Domoticz.Log("onStop called")
+        log.Log("onStop called")
+        self.PublishStats()
+        self.SaveSnapshot()
 
-    def onConnect(self, Connection, Status, Description):
-        Domoticz.Debug("onConnect called")
-        Domoticz.Log("Value changed")
-        Domoticz.Debug("Status = "+str(Status))
-        Domoticz.Debug("Description = "+str(Description))
-        if (Status == 0):
-            Domoticz.Log("Atag One connected successfully.")
-            if self.hostAuth:
-                if self.setLevel:
-                    Domoticz.Log("Setting Atag One target temperature.")
-                    self.UpdateTargetTemp(self.newLevel)
+    def ParseSensors(self, text):
+        # Keys of the devices to create and update: empty = all but OPTIONAL_FIELDS,
+        # 'all', or a list of field keys where 'default' stands for the empty setting
+        keys = [field.key for field in self.FIELDS if field.unit != None]
+        default = [key for key in keys if key not in self.OPTIONAL_FIELDS]
+        words = [word.strip() for word in text.replace(';', ',').split(',') if word.strip() != '']
+        if (len(words) == 0):
+            return set(default)
+        enabled = set()
+        for word in words:
+            if (word.lower() == 'all'):
+                enabled.update(keys)
+            elif (word.lower() == 'default'):
+                enabled.update(default)
+            elif (word in keys):
+                enabled.add(word)
+            else:
+                log.Error('Unknown sensor %s in the Sensors setting, choose from %s', word, ', '.join(keys))
+        return enabled
+
+    def ParseWriteLimits(self, text):
+        # Device writes setting: min and refresh override DEVICE_MIN_INTERVAL and
+        # DEVICE_REFRESH_INTERVAL (seconds), a field key sets that sensor's deadband
+        # ('none' writes every change at once)
+        deadbands = {}
+        keys = [field.key for field in self.FIELDS if field.unit != None]
+        for item in text.replace(';', ',').split(','):
+            if (item.strip() == ''):
+                continue
+            (name, separator, value) = item.partition('=')
+            (name, value) = (name.strip(), value.strip())
+            number = ParseFloat(value, None)
+            if (name in ('min', 'refresh')) and (number != None) and (number >= 0):
+                if (name == 'min'):
+                    self.shadow.minInterval = number
                 else:
-                    Domoticz.Log("Requesting Atag One details.")
-                    self.RequestDetails()
+                    self.shadow.refreshInterval = number
+            elif (name in keys) and ((value.lower() == 'none') or ((number != None) and (number >= 0))):
+                deadbands[name] = None if (value.lower() == 'none') else number
             else:
-                Domoticz.Log("Requesting Atag One authorization.")
-                self.Authenticate()
-        else:
-            Domoticz.Log("Failed to connect ("+str(Status)+") to: "+Parameters["Address"]+":"+str(self.HTTP_CLIENT_PORT)+" with error: "+Description)
-            self.countDown = 6
+                log.Error('Invalid %s in the Device writes setting, use min=, refresh= or <sensor>=<deadband>', item.strip())
+        if (len(deadbands) > 0):
+            self.FIELDS = tuple([field._replace(deadband=deadbands[field.key]) if (field.key in deadbands) else field for field in self.FIELDS])
+
+    def SelectFields(self, enabled):
+        # Split FIELDS once into what is written, decoded and fetched, so a poll
+        # never touches a disabled field or fetches a section nobody reads
+        self.deviceFields = [field for field in self.FIELDS if (field.unit != None) and (field.key in enabled)]
+        self.derivedFields = [field for field in self.deviceFields if field.section in self.COMPUTED_SECTIONS]
+        self.sampling = len([field for field in self.derivedFields if field.section == 'derived']) > 0
+        needed = set(enabled) | set(self.REQUIRED_FIELDS) | (set(self.SAMPLE_FIELDS) if self.sampling else set())
+        self.decodeFields = [field for field in self.FIELDS if (field.key in needed) and (field.section not in self.COMPUTED_SECTIONS)]
+        self.wantedSections = set([field.section.split('.')[0] for field in self.decodeFields if field.section.split('.')[0] in self.SECTIONS])
+        self.controlFields = dict([(field.unit, field) for field in self.deviceFields if field.key in self.CONTROLS])
+        log.Debug('Atag One sensors: %s, fetching %s', ', '.join([field.key for field in self.deviceFields]), ', '.join(sorted(self.wantedSections)))
+
+    def CreateDevices(self, restored):
+        # One pass over every thermostat's enabled fields, then create what is missing
+        images = {}
+        missing = []
+        for thermostat in self.thermostats:
+            for (field, unit) in thermostat.MissingDevices():
+                missing.append((thermostat, field, unit))
+        for (thermostat, field, unit) in missing:
+            options = dict(field.device)
+            if ('Image' in options):
+                if (options['Image'] not in images):
+                    images[options['Image']] = Images[options['Image']].ID
+                options['Image'] = images[options['Image']]
+            name = ('%s %d' % (field.name, thermostat.index + 1)) if thermostat.several else field.name
+            Domoticz.Device(Name=name, Unit=unit, **options).Create()
+            # Seed from the snapshot if there is one, never with made-up zeros
+            values = restored.get(thermostat.configured, {})
+            if (field.key in values):
+                (nValue, sValue) = DeviceValue(values[field.key])
+                UpdateDevice(unit, nValue, sValue)
+        if (len(missing) > 0):
+            log.Log('Created %d Atag One devices', len(missing))
+
+    def SnapshotPath(self):
+        return Parameters["HomeFolder"]+(self.SNAPSHOT_FILE % Parameters.get("HardwareID", ""))
+
+    def LoadSnapshot(self):
+        # Returns {configured address: decoded last-known readings} for the
+        # thermostats that could be restored
+        try:
+            with open(self.SnapshotPath()) as snapshotFile:
+                snapshot = json.load(snapshotFile)
+        except (IOError, OSError, ValueError):
+            return {}
+        if (snapshot.get('mac') != self.hostMac) or (not isinstance(snapshot.get('thermostats'), list)):
+            log.Log('Atag One snapshot is for another MAC or plugin version, ignoring it')
+            return {}
+        age = max(0, time.time() - snapshot.get('saved', 0))
+        entries = dict([(entry.get('configured'), entry) for entry in snapshot['thermostats']])
+        restored = {}
+        for thermostat in self.thermostats:
+            if (thermostat.configured in entries):
+                restored[thermostat.configured] = thermostat.Restore(entries[thermostat.configured], age)
+        for thermostat in self.thermostats:
+            # Never start out on an address that belongs to another configured thermostat
+            others = [other for other in self.thermostats if other is not thermostat]
+            if (thermostat.address != thermostat.configured) and (thermostat.address in [other.configured for other in others] + [other.address for other in others]):
+                thermostat.log.Log('Atag One ignoring restored address %s, it belongs to another thermostat', thermostat.address)
+                thermostat.address = thermostat.configured
+        return restored
+
+    def SaveSnapshot(self):
+        snapshot = { 'saved': time.time(),
+                     'mac': self.hostMac,
+                     'thermostats': [thermostat.Snapshot() for thermostat in self.thermostats] }
+        path = self.SnapshotPath()
+        try:
+            with open(path+'.tmp', 'w') as snapshotFile:
+                json.dump(snapshot, snapshotFile)
+            os.replace(path+'.tmp', path)
+        except (IOError, OSError, TypeError, ValueError) as error:
+            log.ErrorLimited('Unable to write snapshot: %s', error)
+
+    def Route(self, Connection):
+        # Every thermostat has its own connection name
+        for thermostat in self.thermostats:
+            if (Connection.Name == thermostat.connName):
+                return thermostat
+        log.Debug("Ignoring callback for unknown connection %s", Connection.Name)
+        return None
+
+    def onConnect(self, Connection, Status, Description):
+        log.Debug("onConnect called, Status = %s, Description = %s", Status, Description)
+        thermostat = self.Route(Connection)
+        if (thermostat != None):
+            thermostat.OnConnect(Connection, Status, Description)
 
     def onMessage(self, Connection, Data):
-        Domoticz.Debug("onMessage called")
-        Status = int(Data["Status"])
-        Domoticz.Debug("onMessage Data = "+str(Data))
-        if (self.atagConn.Connecting() or self.atagConn.Connected()):
-            Domoticz.Debug("Connection is alive.")
-            
-        if (Status == 200):            
-            strData = Data["Data"].decode("utf-8", "ignore")
-            Domoticz.Debug('Atag One response: '+strData)
-            atagResponse = json.loads(strData)
-            if ('retrieve_reply' in atagResponse):
-                self.countDown = self.ProcessDetails(atagResponse['retrieve_reply'])
-                return
-            
-            if ('pair_reply' in atagResponse):
-                self.countDown = self.ProcessAuthorization(atagResponse['pair_reply'])
-                return
-            
-            if ('update_reply' in atagResponse):
-                Domoticz.Debug("Update_reply = "+str(atagResponse['update_reply']))
-                self.ProcessUpdate(atagResponse['update_reply'])
-            else:
-                Domoticz.Log('Unknown response from Atag One')
-        else:
-            Domoticz.Error('Atag One returned status='+Data['Status'])
-        self.countDown = 6
+        log.Debug("onMessage called")
+        if (Connection.Name == self.discoveryConn.Name):
+            self.ProcessAnnouncement(Connection.Address, Data)
+            return
+        thermostat = self.Route(Connection)
+        if (thermostat != None):
+            thermostat.OnMessage(Connection, Data)
 
     def onCommand(self, Unit, Command, Level, Hue):
-        Domoticz.Log("onCommand called for Unit " + str(Unit) + ": Parameter '" + str(Command) + "', Level: " + str(Level))
-        if (int(Unit) == self.TARGET_TEMP_UNIT) and (int(Unit) in Devices) and (str(Command) == 'Set Level'):
-            if (self.atagConn == None) or (not self.atagConn.Connected()):
-                self.setLevel = True
-                self.newLevel = Level
-                Domoticz.Debug('Attempting to reconnect Atag One')
-                self.SetupConnection()
-            else:
-                Domoticz.Log('Requesting Atag One details')
-                self.UpdateTargetTemp(Level)
+        log.Log("onCommand called for Unit %s: Parameter '%s', Level: %s", Unit, Command, Level)
+        index = int(Unit) // self.UNIT_BLOCK
+        field = self.controlFields.get(int(Unit) % self.UNIT_BLOCK)
+        if (index >= len(self.thermostats)) or (field == None) or (int(Unit) not in Devices):
+            return
+        self.thermostats[index].OnCommand(field, Command, Level)
+        self.FlushCommands()
 
     def onNotification(self, Name, Subject, Text, Status, Priority, Sound, ImageFile):
-        Domoticz.Debug("onNotification called")
-        Domoticz.Log("Notification: " + Name + "," + Subject + "," + Text + "," + Status + "," + str(Priority) + "," + Sound + "," + ImageFile)
+        log.Debug("onNotification called")
+        log.Log("Notification: %s,%s,%s,%s,%s,%s,%s", Name, Subject, Text, Status, Priority, Sound, ImageFile)
 
     def onDisconnect(self, Connection):
-        Domoticz.Debug("onDisconnect called")
+        log.Debug("onDisconnect called")
+        thermostat = self.Route(Connection)
+        if (thermostat != None):
+            thermostat.OnDisconnect(Connection)
 
     def onHeartbeat(self):
-        Domoticz.Debug("onHeartbeat called")
-        if (self.atagConn != None) and (self.atagConn.Connecting()):
+        log.Debug("onHeartbeat called")
+        for thermostat in self.thermostats:
+            thermostat.CheckTimeouts()
+        self.FlushCommands()
+        self.PollDue()
+        if (time.monotonic() >= self.nextStats):
+            self.nextStats = time.monotonic() + self.STATS_INTERVAL
+            self.PublishStats()
+        if (time.monotonic() >= self.nextSnapshot):
+            self.nextSnapshot = time.monotonic() + self.SNAPSHOT_INTERVAL
+            self.SaveSnapshot()
+
+    def PollDue(self):
+        # At most one poll starts per heartbeat, the longest overdue thermostat
+        # first, so several thermostats never hit the LAN in the same burst
+        due = [thermostat for thermostat in self.thermostats if thermostat.scheduler.Due()]
+        if (len(due) > 0):
+            min(due, key=lambda thermostat: thermostat.scheduler.nextPoll).Poll()
+
+    def CreateStatsDevices(self):
+        for (unit, name, axis) in ((self.STATS_LATENCY_UNIT, 'Stats Poll Latency p95', 'ms'),
+                                   (self.STATS_PARSE_UNIT, 'Stats Parse Time p95', 'ms'),
+                                   (self.STATS_PROCESS_UNIT, 'Stats Process Time p95', 'ms'),
+                                   (self.STATS_BYTES_UNIT, 'Stats Response Size', 'bytes'),
+                                   (self.STATS_RECONNECTS_UNIT, 'Stats Reconnects', 'count'),
+                                   (self.STATS_SKIPPED_UNIT, 'Stats Device Writes Skipped', '%')):
+            if (unit not in Devices):
+                Domoticz.Device(Name=name, Unit=unit, Type=243, Subtype=31, Options={'Custom': '1;'+axis}).Create()
+
+    def PublishStats(self):
+        if (self.statsMode in ('File', 'Both')):
+            try:
+                with open(Parameters["HomeFolder"]+self.STATS_FILE, 'w') as statsFile:
+                    json.dump(self.stats.Snapshot(), statsFile, indent=1)
+            except (IOError, OSError) as error:
+                log.ErrorLimited('Unable to write statistics file: %s', error)
+        if (self.statsMode in ('Devices', 'Both')):
+            writes = self.stats.counters['device_writes'] + self.stats.counters['device_skipped']
+            skipped = (100.0 * self.stats.counters['device_skipped'] / writes) if writes > 0 else 0.0
+            for (unit, value) in ((self.STATS_LATENCY_UNIT, self.stats.Percentile('round_trip_ms', 95)),
+                                  (self.STATS_PARSE_UNIT, self.stats.Percentile('json_ms', 95)),
+                                  (self.STATS_PROCESS_UNIT, self.stats.Percentile('process_ms', 95)),
+                                  (self.STATS_BYTES_UNIT, self.stats.Percentile('response_bytes', 50)),
+                                  (self.STATS_RECONNECTS_UNIT, self.stats.Reconnects()),
+                                  (self.STATS_SKIPPED_UNIT, skipped)):
+                if (value != None):
+                    UpdateDevice(unit, 0, str(round(value, 2)))
+
+    def FlushCommands(self):
+        busy = False
+        for thermostat in self.thermostats:
+            thermostat.FlushCommands()
+            busy = busy or thermostat.commands.Busy()
+        # Tick every second while a command is being debounced or confirmed
+        if busy != self.fastHeartbeat:
+            self.fastHeartbeat = busy
+            Domoticz.Heartbeat(1 if self.fastHeartbeat else self.HEARTBEAT_INTERVAL)
+
+    def ProcessAnnouncement(self, address, data):
+        deviceId = protocol.ParseAnnouncement(data)
+        if (deviceId == None):
+            log.Debug("Ignoring discovery message from %s", address)
+            return
+        log.Debug("Atag One %s announced at %s", deviceId, address)
+        self.addresses.Seen(address, deviceId)
+        for thermostat in self.thermostats:
+            if (address != thermostat.address):
+                thermostat.Failover()
+
+class Thermostat:
+    # Connection, request queue, poll timing and command state of one Atag One;
+    # its devices are the FIELDS units offset by index * UNIT_BLOCK
+    STATE_DISCONNECTED = 'disconnected'
+    STATE_CONNECTING = 'connecting'
+    STATE_AUTHORIZING = 'authorizing'
+    STATE_IDLE = 'idle'
+    STATE_BUSY = 'busy'
+
+    def __init__(self, plugin, index, address, several):
+        self.plugin = plugin
+        self.index = index
+        self.unitBase = index * plugin.UNIT_BLOCK
+        self.configured = address
+        self.address = address
+        self.connName = 'AtagOneLocalConn' if (index == 0) else 'AtagOneLocalConn%d' % (index + 1)
+        # Only tell thermostats apart in the log when there is more than one
+        self.log = PluginLog('[%d] ' % (index + 1) if several else '')
+        self.log.debugging = log.debugging
+        self.several = several
+        self.hostAuth = True
+        self.atagConn = None
+        self.connectedOnce = False # connects after the first one count as reconnects
+        self.connState = self.STATE_DISCONNECTED
+        self.requestQueue = []
+        self.assembler = protocol.ResponseAssembler()
+        self.deviceId = None
+        self.lastReport = None
+        self.dhwLimits = (plugin.DHW_TEMPERATURE_MIN, plugin.DHW_TEMPERATURE_MAX)
+        self.scheduler = PollScheduler(plugin.POLL_INTERVAL_FAST, plugin.POLL_INTERVAL_BASE, plugin.POLL_INTERVAL_MAX,
+                                       plugin.RETRY_INTERVAL_MIN, plugin.RETRY_INTERVAL_MAX)
+        self.sections = SectionCache(plugin.SECTIONS)
+        self.samples = SampleBuffer(plugin.SAMPLE_CAPACITY, plugin.SAMPLE_WINDOW)
+        self.tracker = RequestTracker(plugin.REQUEST_TIMEOUT)
+        self.commands = CommandQueue(ParseFloat(Parameters["Mode3"], plugin.COMMAND_WINDOW))
+
+    def MissingDevices(self):
+        # (field, unit) of the enabled devices Domoticz doesn't have (yet)
+        return [(field, field.unit + self.unitBase) for field in self.plugin.deviceFields if (field.unit + self.unitBase) not in Devices]
+
+    def Snapshot(self):
+        return { 'configured': self.configured,
+                 'address': self.address,
+                 'deviceId': self.deviceId,
+                 'hostAuth': self.hostAuth,
+                 'report': self.lastReport,
+                 'scheduler': self.scheduler.Snapshot(),
+                 'sections': self.sections.Snapshot() }
+
+    def Restore(self, snapshot, age):
+        # Returns the decoded last-known readings, {} when they are too old
+        self.hostAuth = bool(snapshot.get('hostAuth', True))
+        self.address = snapshot.get('address', self.address)
+        self.deviceId = snapshot.get('deviceId')
+        self.scheduler.Restore(snapshot.get('scheduler', {}))
+        self.sections.Restore(snapshot.get('sections', {}), age)
+        self.log.Log('Atag One restored state from %d minutes ago (%s)', age / 60, 'paired' if self.hostAuth else 'not paired')
+        if (snapshot.get('report') == None) or (age > self.plugin.SNAPSHOT_MAX_AGE):
+            return {}
+        self.lastReport = snapshot['report']
+        return DecodeFields(self.plugin.decodeFields, self.sections.Merge(dict(self.lastReport)))
+
+    def OnConnect(self, Connection, Status, Description):
+        if (Connection.Address != self.address):
+            self.log.Debug("Ignoring connection to previous address %s", Connection.Address)
+            return
+        if (Status == 0):
+            self.log.Debug("Atag One connected successfully.")
+            self.log.Reset("Failed to connect (%s) to: %s:%s with error: %s")
+            self.assembler.Reset()
+            self.connectedOnce = True
+            self.connState = self.STATE_IDLE
+            self.SendNext()
+        else:
+            self.log.LogLimited("Failed to connect (%s) to: %s:%s with error: %s", Status, self.address, self.plugin.HTTP_CLIENT_PORT, Description)
+            self.connState = self.STATE_DISCONNECTED
+            self.scheduler.Failure()
+            self.Failover()
+
+    def OnMessage(self, Connection, Data):
+        if (Connection.Address != self.address):
+            self.log.Debug("Ignoring reply from previous address %s", Connection.Address)
+            return
+        # Raw bytes as they arrived, a reply may be split over several callbacks
+        try:
+            responses = self.assembler.Feed(Data)
+        except protocol.ProtocolError as error:
+            self.log.ErrorLimited('Atag One sent a malformed reply: %s', error)
+            # The reply boundaries are lost, start over on a fresh connection
+            self.connState = self.STATE_DISCONNECTED
+            self.atagConn.Disconnect()
+            self.RequestsLost(self.tracker.Drop())
             return
-        if self.countDown >= 0: self.countDown -= 1
-        if self.countDown == 0:
-            if (self.atagConn == None) or (not self.atagConn.Connected()):
-                Domoticz.Debug('Attempting to reconnect AtagOne')
-                self.SetupConnection()
+        for (Status, body) in responses:
+            self.plugin.stats.Add('response_bytes', len(body))
+            # The reply frees the connection, anything queued by the handlers below
+            # goes out on the same socket
+            self.connState = self.STATE_IDLE
+            try:
+                self.HandleResponse(Status, body)
+            finally:
+                self.SendNext()
+
+    def OnCommand(self, field, Command, Level):
+        if (str(Command) == 'Set Level'):
+            value = field.kind.Value(Level) if isinstance(field.kind, Selector) else Level
+        elif (str(Command) == 'Off') and isinstance(field.kind, Selector):
+            # Domoticz sends Off for a selector set to level 0
+            value = field.kind.Value(0)
+        elif (str(Command) in ('On', 'Off')) and (not isinstance(field.kind, Selector)):
+            value = 1 if (str(Command) == 'On') else 0
+        else:
+            return
+        # Changes to several controls within the debounce window go out as one update
+        self.commands.Add(field.key, value)
+        self.scheduler.Boost()
+
+    def OnDisconnect(self, Connection):
+        if (Connection.Address != self.address):
+            return
+        lostRequest = self.connState in (self.STATE_BUSY, self.STATE_AUTHORIZING)
+        self.connState = self.STATE_DISCONNECTED
+        self.assembler.Reset()
+        if lostRequest:
+            self.log.LogLimited('Atag One closed the connection before replying')
+            self.RequestsLost(self.tracker.Drop())
+        elif (len(self.requestQueue) > 0):
+            self.SetupConnection()
+
+    def FlushCommands(self):
+        if self.commands.Ready():
+            if not self.UpdateControl(self.commands.Take()):
+                self.commands.Abort()
+
+    def HandleResponse(self, Status, body):
+        if (Status == 200):            
+            self.log.Debug('Atag One response: %s', body)
+            startTime = time.perf_counter()
+            try:
+                (replyType, reply) = protocol.ParseReply(body)
+            except protocol.ProtocolError as error:
+                seqnr = self.tracker.Oldest()
+                self.ReplyUnusable(seqnr, self.tracker.Path(seqnr))
+                self.tracker.Complete(seqnr)
+                self.log.LogLimited('Unknown response from Atag One: %s', error)
+                self.scheduler.Failure()
+                return
+            self.plugin.stats.Add('json_ms', (time.perf_counter() - startTime) * 1000)
+            seqnr = self.tracker.Match(reply.get('seqnr'))
+            if (seqnr == None):
+                self.log.LogLimited('Atag One ignoring unexpected %s seqnr=%s', replyType, reply.get('seqnr'))
+                return
+            if (seqnr != reply.get('seqnr')):
+                self.log.Debug('Atag One %s echoed seqnr=%s, taking it as the reply to seqnr=%s', replyType, reply.get('seqnr'), seqnr)
+            roundTrip = self.tracker.Complete(seqnr)
+            self.log.Debug('Atag One %s seqnr=%s after %dms', replyType, seqnr, roundTrip * 1000)
+            self.plugin.stats.Add('round_trip_ms', roundTrip * 1000)
+
+            if (replyType == 'retrieve_reply'):
+                startTime = time.perf_counter()
+                self.ProcessDetails(reply, seqnr)
+                self.plugin.stats.Add('process_ms', (time.perf_counter() - startTime) * 1000)
+            elif (replyType == 'pair_reply'):
+                self.ProcessAuthorization(reply)
             else:
-                if self.hostAuth:
-                    Domoticz.Log('Requesting Atag One details')
-                    self.RequestDetails()
-                else:
-                    Domoticz.Log("Requesting Atag One authorization.")
-                    self.Authenticate()
+                self.log.Debug("Update_reply = %s", reply)
+                self.ProcessUpdate(reply)
+            return
+        else:
+            seqnr = self.tracker.Oldest()
+            self.ReplyUnusable(seqnr, self.tracker.Path(seqnr))
+            self.tracker.Complete(seqnr)
+            self.log.ErrorLimited('Atag One returned status=%s', Status)
+        self.scheduler.Failure()
+
+    def ReplyUnusable(self, seqnr, path):
+        # The reply to seqnr came back but can't be used. If a command waited on it
+        # (its /update or read-back) nothing else will confirm or resend it, let it go.
+        if (self.commands.inFlight != None) and ((path == protocol.UPDATE) or self.commands.IsReadBack(seqnr)):
+            self.log.Error('Atag One control update %s not confirmed, unusable reply', FormatControl(self.commands.inFlight or {}))
+            self.commands.Abort()
+
+    def CheckTimeouts(self):
+        expired = self.tracker.Expired()
+        if (len(expired) == 0):
+            return
+        self.plugin.stats.Count('timeouts')
+        self.log.LogLimited('Atag One did not answer within %ss (seqnr %s)', self.plugin.REQUEST_TIMEOUT, [request[0] for request in expired])
+        # The reply may still turn up on this socket, start over on a fresh one
+        self.connState = self.STATE_DISCONNECTED
+        self.atagConn.Disconnect()
+        self.RequestsLost(expired)
+
+    def RequestsLost(self, requests):
+        for (seqnr, sendData, attempt) in requests:
+            if (attempt < self.plugin.REQUEST_RETRIES):
+                self.log.Debug('Retrying Atag One request seqnr=%s', seqnr)
+                self.requestQueue.insert(0, (seqnr, sendData, attempt + 1))
+            else:
+                self.log.LogLimited('Atag One request %s seqnr=%s aborted', sendData['URL'], seqnr)
+                if (sendData['URL'] == '/update'):
+                    self.log.Error('Atag One control update lost')
+                    self.commands.Abort()
+                elif self.commands.IsReadBack(seqnr):
+                    self.log.Error('Atag One control update not confirmed, read-back lost')
+                    self.commands.Abort()
+                self.scheduler.Failure()
+        if self.Failover():
+            return
+        if (len(self.requestQueue) > 0) and (self.connState == self.STATE_DISCONNECTED):
+            self.SetupConnection()
+
+    def Failover(self):
+        # After repeated failures move to wherever the thermostat last announced
+        # itself; returns True when a new connection was started
+        if (self.scheduler.failures < self.plugin.FAILOVER_FAILURES) or (self.connState not in (self.STATE_DISCONNECTED, self.STATE_CONNECTING)):
+            return False
+        others = [other for other in self.plugin.thermostats if other is not self]
+        if (self.deviceId == None) and (len(others) > 0):
+            # Any announcement could be one of the other thermostats
+            return False
+        excluded = [other.address for other in others] + [other.configured for other in others]
+        address = self.plugin.addresses.Lookup(self.deviceId, self.address, excluded, [other.deviceId for other in others if other.deviceId != None])
+        if (address == None):
+            return False
+        self.log.Log("Atag One not reachable at %s, switching to discovered address %s", self.address, address)
+        self.address = address
+        # The old connection is left to fail, its callbacks no longer match self.address
+        self.atagConn = None
+        self.connState = self.STATE_DISCONNECTED
+        if (len(self.requestQueue) > 0):
+            self.SetupConnection()
+        else:
+            self.Poll()
+        return True
+
+    def Poll(self):
+        self.scheduler.Wait()
+        if (self.connState in (self.STATE_CONNECTING, self.STATE_BUSY, self.STATE_AUTHORIZING)):
+            # Still waiting on the link, look again on the next heartbeat
+            self.scheduler.Retry()
+            return
+        if self.hostAuth:
+            self.log.Debug('Requesting Atag One details')
+            self.RequestDetails()
+        else:
+            self.log.Log("Requesting Atag One authorization.")
+            self.Authenticate()
 
     def SetupConnection(self):
-        Domoticz.Debug("SetupConnection called")
-        self.atagConn = Domoticz.Connection(Name='AtagOneLocalConn', Transport="TCP/IP", Protocol="HTTP", Address=Parameters["Address"], Port=self.HTTP_CLIENT_PORT)
-        self.atagConn.Connect()
-        # self.Authenticate()
-        newCountDown = 1
+        self.log.Debug("SetupConnection called")
+        # Keep one connection object for the lifetime of the plugin, only (re)connect it
+        if (self.atagConn == None):
+            # Raw TCP, replies are framed by the thermostat's ResponseAssembler
+            self.atagConn = Domoticz.Connection(Name=self.connName, Transport="TCP/IP", Protocol="None", Address=self.address, Port=self.plugin.HTTP_CLIENT_PORT)
+        if (not self.atagConn.Connected()) and (not self.atagConn.Connecting()):
+            self.connState = self.STATE_CONNECTING
+            self.plugin.stats.Count('connects')
+            if self.connectedOnce:
+                self.plugin.stats.Count('reconnects')
+            self.atagConn.Connect()
+
+    def SendRequest(self, seqnr, sendData):
+        # Returns the seqnr of the request that will carry sendData. Polls (retrieve
+        # and pair) are queued once, however often Poll runs while the link is down.
+        queued = [queued[0] for queued in self.requestQueue if queued[1]['URL'] == sendData['URL']]
+        if (sendData['URL'] in (protocol.RETRIEVE, protocol.PAIR)) and (len(queued) > 0):
+            # Still (re)connect below, the queued one may be left over from a failed connect
+            self.log.Debug('Atag One %s already queued', sendData['URL'])
+            seqnr = queued[0]
+        else:
+            self.requestQueue.append((seqnr, sendData, 0))
+        if (self.connState == self.STATE_IDLE):
+            self.SendNext()
+        elif (self.connState == self.STATE_DISCONNECTED):
+            self.log.Debug('Attempting to reconnect Atag One')
+            self.SetupConnection()
+        return seqnr
+
+    def SendNext(self):
+        if (self.connState != self.STATE_IDLE) or (len(self.requestQueue) == 0):
+            return
+        (seqnr, sendData, attempt) = self.requestQueue.pop(0)
+        if (sendData['URL'] == protocol.PAIR):
+            self.connState = self.STATE_AUTHORIZING
+        else:
+            self.connState = self.STATE_BUSY
+        self.tracker.Sent(seqnr, sendData, attempt)
+        self.atagConn.Send(sendData['Data'])
+
+    def HttpRequest(self, path, message):
+        # Queue entry for a protocol payload, Data is the complete HTTP request
+        return { 'URL'  : path,
+                 'Data' : protocol.EncodeRequest(path, message, self.address, self.plugin.HTTP_CLIENT_PORT) }
 
     def RequestDetails(self):
-        Domoticz.Debug("RequestDetails called")
-        payload = { "retrieve_message": { "seqnr": 1, 
-                                          "account_auth" : { "user_account": "",
-                                                             "mac_address": self.hostMac },
-                                          "info": self.MESSAGE_INFO_CONTROL+self.MESSAGE_INFO_REPORT } }
-        sendData = { 'Verb' : 'POST',
-                     'URL'  : '/retrieve',
-                     'Headers' : { 'User-Agent': "Mozilla/5.0 (compatible; AtagOneLocalAPI/1.0.0; http://atag.one/)",
-                                   'X-OneApp-Version': '1.0.0', \
-                                   'Content-Type': 'application/json; UTF-8', \
-                                   'Connection': 'keep-alive', \
-                                   'Accept': '*/*', \
-                                   'Accept-Charset': 'UTF-8', \
-                                   'Host': Parameters["Address"]+":"+str(self.HTTP_CLIENT_PORT) },
-                     'Data' : json.dumps(payload)
-                   }
-        self.atagConn.Send(sendData)
+        self.log.Debug("RequestDetails called")
+        seqnr = self.tracker.Next()
+        message = protocol.RetrieveMessage(seqnr, self.plugin.hostMac, self.sections.Info(self.plugin.wantedSections))
+        return self.SendRequest(seqnr, self.HttpRequest(protocol.RETRIEVE, message))
         
-    def ProcessDetails(self, response):
-        Domoticz.Debug("ProcessDetails called")
-        Domoticz.Debug("ProcessDetails response = "+str(response))
-        newCountDown = 6
-        if (('acc_status' in response) and int(response['acc_status']) == 2) and ('report' in response) and ('control' in response):
-            report = response['report']
-            control = response['control']
-            if ('room_temp' in report) and ('ch_mode_temp' in control) and ('boiler_status' in report):
-                roomTemp = report['room_temp']
-                targetTemp = control['ch_mode_temp']
-                boilerStatus = int(report['boiler_status'])
-                Domoticz.Debug('Atag One status retrieved: roomTemp='+str(roomTemp))
-                Domoticz.Debug('Atag One status retrieved: ch_mode_temp='+str(targetTemp))
-                Domoticz.Debug('Atag One status retrieved: boilerStatus='+str(boilerStatus))
-                if ((boilerStatus & 8) == 8):
-                    Domoticz.Debug('Updating with flame ON')
-                    UpdateDevice(self.TARGET_TEMP_UNIT, int(targetTemp), str(targetTemp))
-                else:
-                    Domoticz.Debug('Updating with flame OFF')
-                    UpdateDevice(self.TARGET_TEMP_UNIT, int(targetTemp), str(targetTemp))
-                UpdateDevice(self.ROOM_TEMP_UNIT, int(roomTemp), str(roomTemp))
-            else:
-                Domoticz.Log('Atag One invalid retrieve response (room_temp/ch_mode_temp/boiler_status)')
+    def ProcessDetails(self, response, seqnr=None):
+        self.log.Debug("ProcessDetails response = %s", response)
+        accStatus = protocol.AccStatus(response)
+        if (accStatus == protocol.ACC_DENIED):
+            self.log.ErrorLimited("Atag One acc_status %s", accStatus)
+            self.plugin.stats.Count('auth_failures')
+            self.hostAuth = False
+            self.scheduler.Retry()
+            self.ReplyUnusable(seqnr, protocol.RETRIEVE)
+            return
+        if (accStatus != protocol.ACC_OK) or ('report' not in response) or ('control' not in response):
+            if (accStatus == protocol.ACC_ERROR):
+                self.log.ErrorLimited("Atag One acc_status %s", accStatus)
+            self.log.LogLimited('Atag One missing retrieve response (report and/or control)')
+            self.scheduler.Failure()
+            self.ReplyUnusable(seqnr, protocol.RETRIEVE)
+            return
+
+        response = self.sections.Merge(response)
+        values = DecodeFields(self.plugin.decodeFields, response)
+        if ('device_id' in values):
+            self.deviceId = values['device_id']
+        if ('dhw_min_set' in values) and ('dhw_max_set' in values):
+            self.dhwLimits = (values['dhw_min_set'], values['dhw_max_set'])
+        missing = [field.key for field in self.plugin.decodeFields if (field.key not in values) and (field.section.split('.')[0] in response)]
+        if ('room_temp' in values) and ('boiler_status' in values):
+            if self.plugin.sampling:
+                self.samples.Add(time.time(), values)
+                response['derived'] = self.samples.Metrics()
+            response['boiler'] = protocol.BoilerBits(values['boiler_status'])
+            values.update(DecodeFields(self.plugin.derivedFields, response))
+        if (len(missing) > 0):
+            self.log.LogLimited('Atag One invalid retrieve response (%s)', '/'.join(missing))
+
+        # Hold back controls until a pending command is confirmed (or dropped)
+        held = self.ConfirmCommands(response['control'], seqnr)
+        writes = self.plugin.stats.counters['device_writes']
+        for field in self.plugin.deviceFields:
+            if (field.key not in values) or (field.key in held):
+                continue
+            (nValue, sValue) = DeviceValue(values[field.key])
+            UpdateDevice(field.unit + self.unitBase, nValue, sValue, Deadband=field.deadband)
+
+        if ('room_temp' in values) and ('ch_mode_temp' in values) and ('boiler_status' in values):
+            reading = (values['room_temp'], values['ch_mode_temp'], values['boiler_status'], values.get('ch_setpoint'))
+            flame = ((values['boiler_status'] & protocol.BOILER_FLAME) == protocol.BOILER_FLAME)
+            self.scheduler.Success(reading, flame)
+            self.lastReport = { 'control': response['control'], 'report': response['report'] }
+            self.log.Reset()
+            self.log.Log('Atag One room %s, setpoint %s, flame %s, %d device writes, next poll in %ds',
+                    values['room_temp'], values['ch_mode_temp'], 'on' if flame else 'off',
+                    self.plugin.stats.counters['device_writes'] - writes, self.scheduler.interval)
         else:
-            if (('acc_status' in response) and (int(response['acc_status']) == 3)):
-                self.hostAuth = False
-                newCountDown = 1
-            else:
-                if (('acc_status' in response) and (int(response['acc_status']) == 0)):
-                    newCountDown = 12 # wait longer before retrying
-                Domoticz.Log('Atag One missing retrieve response (report and/or control)')
-                
-        if (('acc_status' in response) and int(response['acc_status']) == 2) and ('report' in response):
-            report = response['report']
-            if ('room_temp' in report):
-                roomTemp = report['room_temp']
-                Domoticz.Debug('Atag One status retrieved: roomTemp='+str(roomTemp))
-                UpdateDevice(self.ROOM_TEMP_UNIT, int(roomTemp), str(roomTemp))
-            else:
-                Domoticz.Log('Atag One invalid retrieve response (room_temp)')
-            if ('outside_temp' in report):
-                outsideTemp = report['outside_temp']
-                Domoticz.Debug('Atag One status retrieved: outside_temp='+str(outsideTemp))
-                UpdateDevice(self.OUTSIDE_TEMP_UNIT, int(outsideTemp), str(outsideTemp))
-            else:
-                Domoticz.Log('Atag One invalid retrieve response (outside_temp)')
-            if ('burning_hours' in report):
-                burningHours = report['burning_hours']
-                Domoticz.Debug('Atag One status retrieved: burning_hours='+str(burningHours))
-                UpdateDevice(self.BURNING_HOURS_UNIT, int(burningHours), str(burningHours))
-            else:
-                Domoticz.Log('Atag One invalid retrieve response (burning_hours)')
-            if ('ch_setpoint' in report):
-                chSetpoint = report['ch_setpoint']
-                Domoticz.Debug('Atag One status retrieved: ch_setpoint='+str(chSetpoint))
-                UpdateDevice(self.CH_SETPOINT_UNIT, int(chSetpoint), str(chSetpoint))
-            else:
-                Domoticz.Log('Atag One invalid retrieve response (ch_setpoint)')
-            if ('dhw_water_temp' in report):
-                dhwWaterTemp = report['dhw_water_temp']
-                Domoticz.Debug('Atag One status retrieved: dhw_water_temp='+str(dhwWaterTemp))
-                UpdateDevice(self.DHW_WATER_TEMP_UNIT, int(dhwWaterTemp), str(dhwWaterTemp))
-            else:
-                Domoticz.Log('Atag One invalid retrieve response (dhw_water_temp)')
-            if ('ch_water_temp' in report):
-                chWaterTemp = report['ch_water_temp']
-                Domoticz.Debug('Atag One status retrieved: ch_water_temp='+str(chWaterTemp))
-                UpdateDevice(self.CH_WATER_TEMP_UNIT, int(chWaterTemp), str(chWaterTemp))
-            else:
-                Domoticz.Log('Atag One invalid retrieve response (ch_water_temp)')
-            if ('ch_water_pres' in report):
-                chWaterPres = report['ch_water_pres']
-                Domoticz.Debug('Atag One status retrieved: dhw_water_pres='+str(chWaterPres))
-                UpdateDevice(self.CH_WATER_PRES_UNIT, int(chWaterPres), str(chWaterPres))
-            else:
-                Domoticz.Log('Atag One invalid retrieve response (ch_water_pres)')
-            if ('ch_return_temp' in report):
-                chReturnTemp = report['ch_return_temp']
-                Domoticz.Debug('Atag One status retrieved: ch_return_temp='+str(chReturnTemp))
-                UpdateDevice(self.CH_RETURN_TEMP_UNIT, int(chReturnTemp), str(chReturnTemp))
-            else:
-                Domoticz.Log('Atag One invalid retrieve response (ch_return_temp)')
+            self.scheduler.Failure()
+
+    def ConfirmCommands(self, control, seqnr):
+        # Returns the control fields the read-back can not be trusted to show yet.
+        # Only the retrieve sent after the thermostat accepted the update can
+        # confirm it; a poll that was already on the wire just holds the fields.
+        inFlight = self.commands.inFlight
+        if (inFlight == None) or (not self.commands.IsReadBack(seqnr)):
+            pass
+        elif self.commands.Confirm(control):
+            self.log.Log('Atag One confirmed %s', FormatControl(inFlight))
+        elif self.commands.Retry():
+            self.log.Debug('Atag One control update not applied yet, resending')
+            if not self.UpdateControl(inFlight):
+                self.commands.Abort()
         else:
-            if (('acc_status' in response) and (int(response['acc_status']) == 3)):
-                Domoticz.Error("Atag One acc_status "+str(response['acc_status']))
-                self.hostAuth = False
-                newCountDown = 1
-            else:
-                if (('acc_status' in response) and (int(response['acc_status']) == 0)):
-                    Domoticz.Error("Atag One acc_status "+str(response['acc_status']))
-                    newCountDown = 12 # wait longer before retrying
-                Domoticz.Log('Atag One missing retrieve response (report)')
-        return newCountDown
-        
+            self.log.Error('Atag One did not apply %s', FormatControl(inFlight))
+            self.commands.Abort()
+        return self.commands.Held()
+
     def Authenticate(self):
-        Domoticz.Debug("Authenticate called")
-        payload = { "pair_message": { "seqnr": 1, 
-                                      "account_auth": { "user_account": "",
-                                                        "mac_address": self.hostMac },
-                                      "accounts": {"entries": [{"user_account": "",
-                                                                "mac_address": self.hostMac,
-                                                                "device_name": self.hostName,
-                                                                "account_type": 0}]} } }
-        sendData = { 'Verb' : 'POST',
-                     'URL'  : '/pair_message',
-                     'Headers' : { 'User-Agent': "Mozilla/5.0",
-                                   'Content-Type': 'application/json', \
-                                   'Connection': 'keep-alive', \
-                                   'Accept': '*/*', \
-                                   'Accept-Charset': 'UTF-8', \
-                                   'Host': Parameters["Address"]+":"+str(self.HTTP_CLIENT_PORT) },
-                     'Data' : json.dumps(payload)
-                   }
-        self.atagConn.Send(sendData)
+        self.log.Debug("Authenticate called")
+        seqnr = self.tracker.Next()
+        message = protocol.PairMessage(seqnr, self.plugin.hostMac, self.plugin.hostName)
+        self.SendRequest(seqnr, self.HttpRequest(protocol.PAIR, message))
         
     def ProcessAuthorization(self, response):
-        Domoticz.Debug("ProcessAuthorization called")
-        newCountDown = 6
-        if ('acc_status' in response):
-            if (int(response['acc_status']) == 2):
-                self.hostAuth = True
-                Domoticz.Log('Atag One connection authorized')
-            else:
-                if (int(response['acc_status']) == 1):
-                    newCountDown = 1                    
-                    Domoticz.Log('Atag One authorization pending')
-                else:
-                    if (int(response['acc_status']) == 3):
-                        Domoticz.Log('Atag One authorization denied. Retry in a minute.')
-                    else:
-                        Domoticz.Log('Atag One invalid pairing response: acc_status='+str(response['acc_status']))
+        self.log.Debug("ProcessAuthorization called")
+        accStatus = protocol.AccStatus(response)
+        if (accStatus == protocol.ACC_OK):
+            self.hostAuth = True
+            self.log.Log('Atag One connection authorized')
+            self.scheduler.Retry()
+        elif (accStatus == protocol.ACC_PENDING):
+            self.log.LogLimited('Atag One authorization pending')
+            self.scheduler.Retry()
         else:
-            Domoticz.Log('Atag One invalid pairing response')
-        return newCountDown
+            if (accStatus == protocol.ACC_DENIED):
+                self.log.LogLimited('Atag One authorization denied. Retrying later.')
+                self.plugin.stats.Count('auth_failures')
+            else:
+                self.log.LogLimited('Atag One invalid pairing response: acc_status=%s', response.get('acc_status'))
+            self.scheduler.Failure()
       
-    def UpdateTargetTemp(self, target):
-        Domoticz.Debug("UpdateTargetTemp called")
-        Domoticz.Debug("target = "+str(target))
-        self.setLevel = False        
-        if (float(target) < self.TEMPERATURE_MIN) or (float(target) > self.TEMPERATURE_MAX):
-            Domoticz.Error('Invalid temperature setting : '+str(target)+'. Should be >='+str(self.TEMPERATURE_MIN)+' and <='+str(self.TEMPERATURE_MAX))
-            return
-        
-        if (self.atagConn.Connecting() or self.atagConn.Connected()):
-            Domoticz.Debug("onConnect called, Connection is alive.")
-        
-        Domoticz.Log('Updating target temperature to '+str(target))
-        payload = { "update_message": { "seqnr": 1, 
-                                        "account_auth":  { "user_account": "",
-                                                           "mac_address": self.hostMac },
-                                        "control": { "ch_mode_temp": target } } }
-        sendData = { 'Verb' : 'POST',
-                     'URL'  : '/update',
-                     'Headers' : { 'User-Agent': "Mozilla/5.0 (compatible; AtagOneLocalAPI/1.0.0; http://atag.one/)",
-                                   'Content-Type': 'application/json; UTF-8', \
-                                   'Accept-Charset': 'UTF-8', \
-                                   'Host': Parameters["Address"]+":"+str(self.HTTP_CLIENT_PORT) },
-                     'Data' : json.dumps(payload)
-                   }
-        Domoticz.Debug("sendData = "+str(sendData))
-        self.atagConn.Send(sendData)
+    def UpdateControl(self, control):
+        # Every control write is range checked here. Refused fields are removed
+        # from control, so the read-back only waits for what was actually sent.
+        self.log.Debug("UpdateControl called, control = %s", control)
+        for key in list(control):
+            (kind, minimum, maximum) = self.plugin.CONTROLS[key]
+            if (key == 'dhw_temp_setp'):
+                (minimum, maximum) = self.dhwLimits
+            try:
+                value = kind(control[key])
+            except (TypeError, ValueError):
+                value = None
+            if (value == None) or (value < minimum) or (value > maximum):
+                self.log.Error('Invalid %s setting : %s. Should be >=%s and <=%s', key, control[key], minimum, maximum)
+                del control[key]
+            else:
+                control[key] = value
+        if (len(control) == 0):
+            return False
+
+        self.log.Log('Updating %s', FormatControl(control))
+        seqnr = self.tracker.Next()
+        sendData = self.HttpRequest(protocol.UPDATE, protocol.UpdateMessage(seqnr, self.plugin.hostMac, control))
+        self.log.Debug("sendData = %s", sendData)
+        self.SendRequest(seqnr, sendData)
+        return True
         
     def ProcessUpdate(self, response):
-        Domoticz.Debug("ProcessUpdate called")
-        Domoticz.Debug("ProcessUpdate response = "+str(response))
-        if (('acc_status' in response) and int(response['acc_status']) == 2) and ('status' in response):
-            Domoticz.Log('Atag One target temperature updated')
-            if (self.atagConn == None) or (not self.atagConn.Connected()):
-                Domoticz.Log('Requesting Atag One details')
-                self.RequestDetails()
-            else:
-                Domoticz.Debug('Attempting to reconnect Atag One')
-                self.SetupConnection()
+        self.log.Debug("ProcessUpdate response = %s", response)
+        if (protocol.AccStatus(response) == protocol.ACC_OK) and ('status' in response):
+            self.log.Debug('Atag One accepted control update')
+            self.sections.Invalidate()
+            # Read the new state back over the same connection, ConfirmCommands checks it
+            self.commands.ReadBack(self.RequestDetails())
         else:
-            Domoticz.Log('Atag One failed update')
+            self.log.LogLimited('Atag One failed update')
+            self.commands.Abort()
       
+class PollScheduler:
+    # Adaptive poll timing: fast while the burner is on or a setpoint was just
+    # changed, backing off while readings stay flat, and exponential backoff
+    # with jitter after failures.
+    BOOST_POLLS = 3
+    BACKOFF_FACTOR = 1.5
+
+    def __init__(self, fastInterval, baseInterval, maxInterval, retryMin, retryMax):
+        self.fastInterval = fastInterval
+        self.baseInterval = baseInterval
+        self.maxInterval = maxInterval
+        self.retryMin = retryMin
+        self.retryMax = retryMax
+        self.interval = baseInterval
+        self.failures = 0
+        self.boost = 0
+        self.lastReading = None
+        self.nextPoll = time.monotonic() # poll right away
+
+    def Due(self):
+        return (self.nextPoll != None) and (time.monotonic() >= self.nextPoll)
+
+    def Wait(self):
+        # A request is in flight; the reply (or failure) schedules the next poll
+        self.nextPoll = None
+
+    def Schedule(self, delay):
+        self.nextPoll = time.monotonic() + delay
+
+    def Retry(self):
+        # Follow-up request needed (pairing, read-back), do it on the next heartbeat
+        self.Schedule(0)
+
+    def Boost(self):
+        self.boost = self.BOOST_POLLS
+        self.interval = self.fastInterval
+
+    def Success(self, reading, flame):
+        self.failures = 0
+        if flame or (self.boost > 0):
+            if self.boost > 0: self.boost -= 1
+            self.interval = self.fastInterval
+        elif (reading != self.lastReading):
+            self.interval = self.baseInterval
+        else:
+            self.interval = min(self.interval * self.BACKOFF_FACTOR, self.maxInterval)
+        self.lastReading = reading
+        self.Schedule(self.interval)
+        log.Debug("Next poll in %ds", self.interval)
+
+    def Snapshot(self):
+        return { 'interval': self.interval, 'lastReading': self.lastReading }
+
+    def Restore(self, snapshot):
+        # Keep the learned pace, but poll right away after a restart
+        self.interval = min(max(snapshot.get('interval', self.baseInterval), self.fastInterval), self.maxInterval)
+        if (snapshot.get('lastReading') != None):
+            self.lastReading = tuple(snapshot['lastReading'])
+
+    def Failure(self):
+        self.failures += 1
+        delay = min(self.retryMin * (2 ** (self.failures - 1)), self.retryMax)
+        delay = random.uniform(delay / 2, delay) # 'equal jitter'
+        self.Schedule(delay)
+        log.Debug("Retry %d in %ds", self.failures, delay)
+
+class CommandQueue:
+    # Coalesces bursts of control changes (e.g. dragging the setpoint slider)
+    # into the latest value per field, and keeps at most one update in flight
+    # until the thermostat reports the new value back.
+    CONFIRM_RETRIES = 2
+    TOLERANCES = { 'vacation_duration': 3600 } # counts down on the thermostat
+
+    def __init__(self, window):
+        self.window = window
+        self.pending = {}
+        self.deadline = 0
+        self.inFlight = None
+        self.readBack = None # seqnr of the retrieve that should show inFlight applied
+        self.retries = 0
+
+    def Add(self, field, value):
+        self.pending[field] = value
+        self.deadline = time.monotonic() + self.window
+
+    def Busy(self):
+        return (self.inFlight != None) or (len(self.pending) > 0)
+
+    def Ready(self):
+        return (self.inFlight == None) and (len(self.pending) > 0) and (time.monotonic() >= self.deadline)
+
+    def Take(self):
+        self.inFlight = self.pending
+        self.pending = {}
+        self.readBack = None
+        self.retries = 0
+        return self.inFlight
+
+    def Held(self):
+        # Fields with a change not confirmed yet
+        return set(self.pending) | set(self.inFlight or ())
+
+    def ReadBack(self, seqnr):
+        self.readBack = seqnr
+
+    def IsReadBack(self, seqnr):
+        return (self.inFlight != None) and (self.readBack != None) and (seqnr == self.readBack)
+
+    def Confirm(self, control):
+        for field in self.inFlight:
+            if (field not in control) or (abs(float(control[field]) - float(self.inFlight[field])) > self.TOLERANCES.get(field, 0.05)):
+                return False
+        self.inFlight = None
+        return True
+
+    def Retry(self):
+        # The resent update gets a read-back of its own
+        self.readBack = None
+        self.retries += 1
+        return self.retries <= self.CONFIRM_RETRIES
+
+    def Abort(self):
+        self.inFlight = None
+        self.readBack = None
+
+class AddressCache:
+    # Where thermostats last announced themselves on the LAN
+    def __init__(self, maxAge):
+        self.maxAge = maxAge
+        self.seen = {} # address: (device id, time)
+
+    def Seen(self, address, deviceId):
+        self.seen[address] = (deviceId, time.monotonic())
+
+    def Lookup(self, deviceId, current, addresses=(), deviceIds=()):
+        # Newest other address announcing deviceId; with no device id known
+        # yet, only an unambiguous single thermostat on the LAN is trusted.
+        # addresses and deviceIds belong to other thermostats and are never returned.
+        now = time.monotonic()
+        fresh = [(seen, address, announced) for (address, (announced, seen)) in self.seen.items()
+                 if (now - seen < self.maxAge) and (address not in addresses) and (announced not in deviceIds)]
+        if (deviceId == None):
+            if (len(set([announced for (seen, address, announced) in fresh])) != 1):
+                return None
+        else:
+            fresh = [entry for entry in fresh if entry[2] == deviceId]
+        candidates = [(seen, address) for (seen, address, announced) in fresh if address != current]
+        if (len(candidates) == 0):
+            return None
+        return max(candidates)[1]
+
+class RequestTracker:
+    # Hands out sequence numbers and remembers the requests on the wire, so
+    # replies can be matched, stalled requests detected and round trips timed.
+    SEQNR_MAX = 65535
+    HISTORY = 50
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.seqnr = 0
+        self.inFlight = {}
+        self.roundTrips = collections.deque(maxlen=self.HISTORY)
+
+    def Next(self):
+        self.seqnr = (self.seqnr % self.SEQNR_MAX) + 1
+        return self.seqnr
+
+    def Sent(self, seqnr, sendData, attempt):
+        sentAt = time.monotonic()
+        self.inFlight[seqnr] = (sendData, attempt, sentAt, sentAt + self.timeout)
+
+    def Match(self, seqnr):
+        # The outstanding request a reply with this seqnr answers, None if there is
+        # none. Requests go out one at a time, so while a single one is in flight
+        # the reply is its answer whatever seqnr the thermostat echoed.
+        if (seqnr in self.inFlight):
+            return seqnr
+        if (len(self.inFlight) == 1):
+            return list(self.inFlight)[0]
+        return None
+
+    def Oldest(self):
+        # seqnr of the longest outstanding request, None when nothing is in flight
+        if (len(self.inFlight) == 0):
+            return None
+        return min(self.inFlight, key=lambda s: self.inFlight[s][2])
+
+    def Path(self, seqnr):
+        # URL of an outstanding request, None when it isn't in flight
+        return self.inFlight[seqnr][0]['URL'] if (seqnr in self.inFlight) else None
+
+    def Complete(self, seqnr):
+        # Returns the round trip in seconds, or None when nobody waits for this reply.
+        # Without a seqnr the oldest outstanding request is assumed.
+        if (seqnr == None):
+            seqnr = self.Oldest()
+        request = self.inFlight.pop(seqnr, None)
+        if (request == None):
+            return None
+        roundTrip = time.monotonic() - request[2]
+        self.roundTrips.append(roundTrip)
+        return roundTrip
+
+    def Expired(self):
+        now = time.monotonic()
+        expired = [seqnr for seqnr in self.inFlight if self.inFlight[seqnr][3] <= now]
+        return [(seqnr,) + self.inFlight.pop(seqnr)[:2] for seqnr in expired]
+
+    def Drop(self):
+        lost = [(seqnr,) + self.inFlight[seqnr][:2] for seqnr in self.inFlight]
+        self.inFlight = {}
+        return lost
+
+class SectionCache:
+    # Slow-changing retrieve sections are only requested once per TTL, the
+    # cached copy fills in for them on the polls in between
+    def __init__(self, sections):
+        self.sections = sections
+        self.cache = {}
+
+    def Info(self, wanted):
+        info = 0
+        now = time.monotonic()
+        for name in wanted:
+            (bit, ttl) = self.sections[name]
+            if (ttl == 0) or (name not in self.cache) or (now - self.cache[name][0] >= ttl):
+                info |= bit
+        return info
+
+    def Merge(self, response):
+        now = time.monotonic()
+        for name in self.sections:
+            if (self.sections[name][1] == 0):
+                continue
+            if (name in response):
+                self.cache[name] = (now, response[name])
+            elif (name in self.cache):
+                response[name] = self.cache[name][1]
+        return response
+
+    def Invalidate(self):
+        # After a write anything cached may be stale
+        self.cache = {}
+
+    def Snapshot(self):
+        now = time.monotonic()
+        return dict([(name, { 'age': now - self.cache[name][0], 'data': self.cache[name][1] }) for name in self.cache])
+
+    def Restore(self, snapshot, age):
+        now = time.monotonic()
+        for name in snapshot:
+            if (name in self.sections) and (self.sections[name][1] > 0):
+                self.cache[name] = (now - snapshot[name]['age'] - age, snapshot[name]['data'])
+
+class SampleBuffer:
+    # Fixed-size, array-backed ring of report samples. Running sums over the
+    # short window (duty cycle, starts, heating rate, delta-T) and over the
+    # whole ring (pressure trend) are updated as samples enter and leave, so
+    # the derived metrics cost the same however much history is kept.
+    CHANNELS = ('time', 'room_temp', 'ch_water_temp', 'ch_return_temp', 'ch_setpoint', 'ch_water_pres', 'flame',
+                'dt', 'on_time', 'start')
+    MIN_SPAN = 900
+
+    def __init__(self, capacity, window):
+        self.capacity = capacity
+        self.window = window
+        self.data = {}
+        for name in self.CHANNELS:
+            self.data[name] = array.array('d', [0.0]) * capacity
+        self.count = 0
+        self.windowStart = 0
+        self.epoch = None
+        self.short = dict.fromkeys(('n', 'dt', 'on_time', 'start', 'delta_t', 'x', 'y', 'xx', 'xy'), 0.0)
+        self.long = dict.fromkeys(('n', 'x', 'y', 'xx', 'xy'), 0.0)
+
+    def Get(self, name, index):
+        return self.data[name][index % self.capacity]
+
+    def Add(self, timestamp, values):
+        if (self.count >= self.capacity):
+            # Overwriting the oldest sample, take it out of the sums first
+            oldest = self.count - self.capacity
+            if (self.windowStart <= oldest):
+                self.Account(self.short, oldest, -1, 'room_temp')
+                self.windowStart = oldest + 1
+            self.Account(self.long, oldest, -1, 'ch_water_pres')
+        if (self.epoch == None):
+            self.epoch = timestamp
+        slot = self.count % self.capacity
+        previous = self.count - 1
+        for name in ('room_temp', 'ch_water_temp', 'ch_return_temp', 'ch_setpoint', 'ch_water_pres'):
+            # Carry the last value forward for anything missing from this report
+            self.data[name][slot] = values[name] if (name in values) else (self.Get(name, previous) if self.count > 0 else 0.0)
+        flame = 1.0 if ((values['boiler_status'] & protocol.BOILER_FLAME) == protocol.BOILER_FLAME) else 0.0
+        self.data['time'][slot] = timestamp
+        self.data['flame'][slot] = flame
+        if (self.count > 0):
+            dt = timestamp - self.Get('time', previous)
+            self.data['dt'][slot] = dt
+            self.data['on_time'][slot] = dt if (self.Get('flame', previous) == 1.0) else 0.0
+            self.data['start'][slot] = 1.0 if ((flame == 1.0) and (self.Get('flame', previous) == 0.0)) else 0.0
+        else:
+            self.data['dt'][slot] = self.data['on_time'][slot] = self.data['start'][slot] = 0.0
+        self.count += 1
+        self.Account(self.short, self.count - 1, 1, 'room_temp')
+        self.Account(self.long, self.count - 1, 1, 'ch_water_pres')
+        while (self.windowStart < self.count - 1) and (self.Get('time', self.windowStart) < timestamp - self.window):
+            self.Account(self.short, self.windowStart, -1, 'room_temp')
+            self.windowStart += 1
+        if (self.count % self.capacity == 0):
+            self.Rebuild()
+
+    def Account(self, sums, index, sign, channel):
+        # x in hours since the first sample keeps the regression sums well conditioned
+        x = (self.Get('time', index) - self.epoch) / 3600.0
+        y = self.Get(channel, index)
+        sums['n'] += sign
+        sums['x'] += sign * x
+        sums['y'] += sign * y
+        sums['xx'] += sign * x * x
+        sums['xy'] += sign * x * y
+        if ('dt' in sums):
+            sums['dt'] += sign * self.Get('dt', index)
+            sums['on_time'] += sign * self.Get('on_time', index)
+            sums['start'] += sign * self.Get('start', index)
+            sums['delta_t'] += sign * (self.Get('ch_water_temp', index) - self.Get('ch_return_temp', index))
+
+    def Rebuild(self):
+        # Recompute from the stored samples now and then so rounding errors can't pile up
+        for sums in (self.short, self.long):
+            for key in sums:
+                sums[key] = 0.0
+        for index in range(max(0, self.count - self.capacity), self.count):
+            self.Account(self.long, index, 1, 'ch_water_pres')
+            if (index >= self.windowStart):
+                self.Account(self.short, index, 1, 'room_temp')
+
+    def Slope(self, sums, first):
+        # Trends over a few minutes of data are noise, wait for MIN_SPAN
+        divisor = sums['n'] * sums['xx'] - sums['x'] * sums['x']
+        span = self.Get('time', self.count - 1) - self.Get('time', first)
+        if (sums['n'] < 2) or (abs(divisor) < 1e-9) or (span < self.MIN_SPAN):
+            return None
+        return (sums['n'] * sums['xy'] - sums['x'] * sums['y']) / divisor
+
+    def Metrics(self):
+        metrics = {}
+        short = self.short
+        if (short['n'] > 0):
+            metrics['delta_t'] = round(short['delta_t'] / short['n'], 1)
+        if (short['dt'] > 0):
+            metrics['duty_cycle'] = round(100.0 * short['on_time'] / short['dt'], 1)
+            metrics['starts_per_hour'] = round(short['start'] * 3600.0 / short['dt'], 1)
+        heatingRate = self.Slope(short, self.windowStart)
+        if (heatingRate != None):
+            metrics['heating_rate'] = round(heatingRate, 2)
+        pressureTrend = self.Slope(self.long, max(0, self.count - self.capacity))
+        if (pressureTrend != None):
+            metrics['pressure_trend'] = round(pressureTrend * 24, 3)
+        return metrics
+
+class PluginLog:
+    # Logging facade: messages are only formatted when their level is enabled,
+    # and the *Limited variants collapse repeats of the same message
+    REPEAT_INTERVAL = 600
+
+    def __init__(self, prefix=''):
+        self.prefix = prefix
+        self.debugging = False
+        self.repeats = {}
+
+    def Debugging(self, enabled):
+        self.debugging = enabled
+        Domoticz.Debugging(1 if enabled else 0)
+
+    def Debug(self, message, *args):
+        if self.debugging:
+            Domoticz.Debug(self.prefix + ((message % args) if args else message))
+
+    def Log(self, message, *args):
+        Domoticz.Log(self.prefix + ((message % args) if args else message))
+
+    def Error(self, message, *args):
+        Domoticz.Error(self.prefix + ((message % args) if args else message))
+
+    def LogLimited(self, message, *args):
+        self.Limited(Domoticz.Log, message, args)
+
+    def ErrorLimited(self, message, *args):
+        self.Limited(Domoticz.Error, message, args)
+
+    def Limited(self, write, message, args):
+        # Keyed on the format string, so the same error with other details counts
+        # as a repeat; a suppressed repeat only keeps its args, it is never formatted
+        now = time.monotonic()
+        suffix = ''
+        if (message in self.repeats):
+            (lastWritten, suppressed, lastArgs) = self.repeats[message]
+            if (now - lastWritten < self.REPEAT_INTERVAL):
+                self.repeats[message] = (lastWritten, suppressed + 1, args)
+                return
+            if (suppressed > 0):
+                suffix = ' (repeated %d times)' % suppressed
+        self.repeats[message] = (now, 0, args)
+        write(self.prefix + ((message % args) if args else message) + suffix)
+
+    def Reset(self, message=None):
+        # The condition cleared, log the next occurrence straight away
+        for key in ([message] if (message != None) else list(self.repeats)):
+            if (key in self.repeats):
+                (lastWritten, suppressed, lastArgs) = self.repeats.pop(key)
+                if (suppressed > 0):
+                    Domoticz.Log("%s'%s' repeated %d more times" % (self.prefix, (key % lastArgs) if lastArgs else key, suppressed))
+
+class PluginStats:
+    # Counters and rolling windows over the plugin's own hot paths
+    WINDOW = 100
+    SERIES = ('round_trip_ms', 'json_ms', 'process_ms', 'response_bytes')
+    COUNTERS = ('connects', 'reconnects', 'timeouts', 'auth_failures', 'device_writes', 'device_skipped')
+
+    def __init__(self):
+        self.started = time.time()
+        self.series = {}
+        for name in self.SERIES:
+            self.series[name] = collections.deque(maxlen=self.WINDOW)
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+
+    def Add(self, name, value):
+        self.series[name].append(value)
+
+    def Count(self, name):
+        self.counters[name] += 1
+
+    def Reconnects(self):
+        return self.counters['reconnects']
+
+    def Percentile(self, name, percent):
+        # Nearest-rank percentile, None until there are samples
+        values = sorted(self.series[name])
+        if (len(values) == 0):
+            return None
+        return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+    def Snapshot(self):
+        snapshot = { 'uptime': round(time.time() - self.started),
+                     'counters': dict(self.counters),
+                     'reconnects': self.Reconnects() }
+        for name in self.SERIES:
+            if (len(self.series[name]) > 0):
+                snapshot[name] = { 'samples': len(self.series[name]),
+                                   'p50': round(self.Percentile(name, 50), 3),
+                                   'p95': round(self.Percentile(name, 95), 3),
+                                   'max': round(max(self.series[name]), 3) }
+        return snapshot
+
+class ShadowCache:
+    # Last value written per unit, so jittery sensors only hit the Domoticz
+    # database when they moved more than their deadband
+    JUMP_DEADBANDS = 10
+
+    def __init__(self, minInterval, refreshInterval):
+        self.minInterval = minInterval
+        self.refreshInterval = refreshInterval
+        self.units = {}
+
+    def Needed(self, Unit, nValue, sValue, Image, Deadband):
+        if (Unit not in self.units):
+            # Nothing written since start, compare against what Domoticz has
+            return (Devices[Unit].nValue != nValue) or (Devices[Unit].sValue != sValue) or ((Image != None) and (Image != Devices[Unit].Image))
+        (lastN, lastS, lastImage, lastWrite) = self.units[Unit]
+        age = time.monotonic() - lastWrite
+        if (lastN != nValue) or ((Image != None) and (Image != lastImage)):
+            return True
+        if (Deadband == None):
+            return (lastS != sValue)
+        if (age >= self.refreshInterval):
+            return True
+        try:
+            change = abs(float(sValue) - float(lastS))
+        except ValueError:
+            return (lastS != sValue)
+        if (age < self.minInterval):
+            # Only a real jump (e.g. a pressure drop) is worth writing this soon
+            return change >= self.JUMP_DEADBANDS * Deadband
+        return change >= Deadband - 1e-9
+
+    def Written(self, Unit, nValue, sValue, Image):
+        self.units[Unit] = (nValue, sValue, Image if (Image != None) else Devices[Unit].Image, time.monotonic())
+
+log = PluginLog()
+
 global _plugin
 _plugin = BasePlugin()
 
@@ -447,18 +1459,44 @@ def onHeartbeat():
     global _plugin
     _plugin.onHeartbeat()
 
-def UpdateDevice(Unit, nValue, sValue, Image=None):
+def UpdateDevice(Unit, nValue, sValue, Image=None, Deadband=None):
     # Make sure that the Domoticz device still exists (they can be deleted) before updating it 
     if (Unit in Devices):
-        if (Devices[Unit].nValue != nValue) or (Devices[Unit].sValue != sValue) or ((Image != None) and (Image != Devices[Unit].Image)):
+        sValue = str(sValue)
+        if _plugin.shadow.Needed(Unit, nValue, sValue, Image, Deadband):
+            _plugin.stats.Count('device_writes')
             if (Image != None) and (Image != Devices[Unit].Image):
-                Devices[Unit].Update(nValue=nValue, sValue=str(sValue), Image=Image)
-                Domoticz.Log("Update "+str(nValue)+":'"+str(sValue)+"' ("+Devices[Unit].Name+") Image="+str(Image))
+                Devices[Unit].Update(nValue=nValue, sValue=sValue, Image=Image)
+                log.Debug("Update %s:'%s' (%s) Image=%s", nValue, sValue, Devices[Unit].Name, Image)
             else:
-                Devices[Unit].Update(nValue=nValue, sValue=str(sValue))
-                Domoticz.Log("Update "+str(nValue)+":'"+str(sValue)+"' ("+Devices[Unit].Name+")")
+                Devices[Unit].Update(nValue=nValue, sValue=sValue)
+                log.Debug("Update %s:'%s' (%s)", nValue, sValue, Devices[Unit].Name)
+            _plugin.shadow.Written(Unit, nValue, sValue, Image)
+        else:
+            _plugin.stats.Count('device_skipped')
 
     # Generic helper functions
+def DecodeFields(fields, response):
+    # Single pass over the field table, returns {key: value} for what was present
+    values = {}
+    for field in fields:
+        section = response
+        for name in field.section.split('.'):
+            section = section.get(name) if isinstance(section, dict) else None
+        if isinstance(section, dict) and (field.key in section):
+            try:
+                value = field.kind(section[field.key])
+            except (TypeError, ValueError):
+                continue
+            values[field.key] = (value * field.scale) if (field.scale != 1) else value
+    return values
+
+def ParseFloat(value, default):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
 def DumpConfigToLog():
     for x in Parameters:
         if Parameters[x] != "":
@@ -0,0 +1,320 @@
+#
+# Minimal stand-in for the Domoticz python plugin framework
+#
+# Enough of the API for plugin.py to run outside Domoticz: Connection (TCP
+# with the HTTP or raw protocol, UDP listeners), Device/Devices, Image/Images,
+# Parameters, Heartbeat and the logging calls. Network callbacks are queued
+# by background threads and delivered on the caller's thread by
+# Runtime.Run(), the same one-callback-at-a-time model Domoticz uses.
+#
+import importlib.util
+import os
+import queue
+import socket
+import sys
+import threading
+import time
+import zipfile
+
+_runtime = None
+
+
+def Log(message):
+    _runtime.Output('Log', message)
+
+
+def Status(message):
+    _runtime.Output('Status', message)
+
+
+def Error(message):
+    _runtime.Output('Error', message)
+
+
+def Debug(message):
+    if _runtime.debugging:
+        _runtime.Output('Debug', message)
+
+
+def Debugging(level):
+    _runtime.debugging = bool(level)
+
+
+def Heartbeat(seconds):
+    _runtime.heartbeat = seconds
+
+
+class Device:
+    def __init__(self, Name='', Unit=0, TypeName='', Type=0, Subtype=0, Switchtype=0, Image=0, Options=None, Used=0, DeviceID=''):
+        self.Name = Name
+        self.Unit = Unit
+        self.ID = Unit
+        self.TypeName = TypeName
+        self.Type = Type
+        self.SubType = Subtype
+        self.SwitchType = Switchtype
+        self.Image = Image
+        self.Options = Options or {}
+        self.Used = Used
+        self.DeviceID = DeviceID
+        self.nValue = 0
+        self.sValue = ''
+        self.LastLevel = 0
+        self.LastUpdate = ''
+        self.Updates = 0
+
+    def Create(self):
+        _runtime.Devices[self.Unit] = self
+
+    def Update(self, nValue=0, sValue='', Image=None, Options=None, TimedOut=0, **kwargs):
+        self.nValue = nValue
+        self.sValue = sValue
+        if Image is not None:
+            self.Image = Image
+        if Options is not None:
+            self.Options = Options
+        self.LastUpdate = time.strftime('%Y-%m-%d %H:%M:%S')
+        self.Updates += 1
+        _runtime.deviceWrites += 1
+
+    def Delete(self):
+        _runtime.Devices.pop(self.Unit, None)
+
+    def __str__(self):
+        return "Unit: %d, Name: '%s', nValue: %d, sValue: '%s'" % (self.Unit, self.Name, self.nValue, self.sValue)
+
+
+class Image:
+    def __init__(self, Filename):
+        self.Filename = Filename
+
+    def Create(self):
+        # Register the icon sets listed in the zip's icons.txt, like Domoticz does
+        with zipfile.ZipFile(os.path.join(_runtime.folder, self.Filename)) as archive:
+            for line in archive.read('icons.txt').decode('utf-8').splitlines():
+                name = line.split(';')[0].strip()
+                if (name != '') and (name not in _runtime.Images):
+                    _runtime.Images[name] = _Image(len(_runtime.Images) + 100, name)
+
+
+class _Image:
+    def __init__(self, ID, Name):
+        self.ID = ID
+        self.Name = Name
+
+
+class Connection:
+    def __init__(self, Name='', Transport='TCP/IP', Protocol='None', Address='', Port='', Baud=0):
+        self.Name = Name
+        self.Transport = Transport
+        self.Protocol = Protocol
+        self.Address = Address
+        self.Port = Port
+        self.socket = None
+        self.state = 'disconnected'
+        self.generation = 0
+
+    def __str__(self):
+        return "Name: '%s', Transport: '%s', Protocol: '%s', Address: '%s', Port: '%s'" % (self.Name, self.Transport, self.Protocol, self.Address, self.Port)
+
+    def Connecting(self):
+        return self.state == 'connecting'
+
+    def Connected(self):
+        return self.state == 'connected'
+
+    def Connect(self):
+        self.state = 'connecting'
+        self.generation += 1
+        threading.Thread(target=self._Connect, args=(self.generation,), daemon=True).start()
+
+    def _Connect(self, generation):
+        try:
+            sock = socket.create_connection((self.Address, int(self.Port)), timeout=_runtime.connectTimeout)
+            sock.settimeout(None)
+        except OSError as error:
+            _runtime.Post(self._Failed, generation, error.errno or 1, str(error))
+            return
+        _runtime.Post(self._Opened, generation, sock)
+
+    def _Failed(self, generation, status, description):
+        if generation == self.generation:
+            self.state = 'disconnected'
+            _runtime.Callback('onConnect', self, status, description)
+
+    def _Opened(self, generation, sock):
+        if generation != self.generation:
+            sock.close()
+            return
+        self.socket = sock
+        self.state = 'connected'
+        threading.Thread(target=self._Read, args=(generation, sock), daemon=True).start()
+        _runtime.Callback('onConnect', self, 0, 'Connected')
+
+    def Listen(self):
+        # UDP only, e.g. for broadcast discovery
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((self.Address or '0.0.0.0', int(self.Port)))
+        self.state = 'connected'
+        threading.Thread(target=self._Receive, args=(self.socket,), daemon=True).start()
+
+    def _Receive(self, sock):
+        while True:
+            try:
+                (data, sender) = sock.recvfrom(65535)
+            except OSError:
+                return
+            peer = Connection(self.Name, self.Transport, self.Protocol, sender[0], str(sender[1]))
+            _runtime.Post(_runtime.Callback, 'onMessage', peer, data)
+
+    def Send(self, Message, Delay=0):
+        if self.socket is None:
+            Error("Send to '%s' failed, not connected" % self.Name)
+            return
+        if self.Protocol == 'HTTP':
+            data = self._Request(Message)
+        elif isinstance(Message, str):
+            data = Message.encode('utf-8')
+        else:
+            data = bytes(Message)
+        _runtime.bytesSent += len(data)
+        try:
+            self.socket.sendall(data)
+        except OSError:
+            self.Disconnect()
+
+    def _Request(self, Message):
+        body = Message.get('Data', '')
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        lines = ['%s %s HTTP/1.1' % (Message.get('Verb', 'GET'), Message.get('URL', '/'))]
+        headers = dict(Message.get('Headers', {}))
+        headers['Content-Length'] = str(len(body))
+        for name in headers:
+            lines.append('%s: %s' % (name, headers[name]))
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('utf-8') + body
+
+    def _Read(self, generation, sock):
+        buffer = b''
+        while True:
+            try:
+                chunk = sock.recv(65536)
+            except OSError:
+                chunk = b''
+            if not chunk:
+                _runtime.Post(self._Closed, generation)
+                return
+            _runtime.bytesReceived += len(chunk)
+            if self.Protocol != 'HTTP':
+                _runtime.Post(self._Deliver, generation, chunk)
+                continue
+            buffer += chunk
+            while b'\r\n\r\n' in buffer:
+                (head, rest) = buffer.split(b'\r\n\r\n', 1)
+                lines = head.decode('latin-1').split('\r\n')
+                headers = {}
+                for line in lines[1:]:
+                    (name, value) = line.split(':', 1)
+                    headers[name.strip()] = value.strip()
+                length = int(headers.get('Content-Length', 0))
+                if len(rest) < length:
+                    break
+                buffer = rest[length:]
+                message = {'Status': lines[0].split(' ')[1], 'Headers': headers, 'Data': rest[:length]}
+                _runtime.Post(self._Deliver, generation, message)
+
+    def _Deliver(self, generation, data):
+        if generation == self.generation:
+            _runtime.Callback('onMessage', self, data)
+
+    def _Closed(self, generation):
+        if (generation == self.generation) and (self.state == 'connected'):
+            self.state = 'disconnected'
+            self.socket.close()
+            _runtime.Callback('onDisconnect', self)
+
+    def Disconnect(self):
+        if self.socket is not None:
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            if self.Transport == 'UDP/IP':
+                self.socket.close()
+                self.state = 'disconnected'
+
+
+class Runtime:
+    # Loads a plugin file as Domoticz would and pumps its callbacks
+    def __init__(self, parameters, verbose=False):
+        global _runtime
+        _runtime = self
+        self.Parameters = dict(parameters)
+        self.Devices = {}
+        self.Images = {}
+        self.debugging = False
+        self.verbose = verbose
+        self.heartbeat = 10
+        self.heartbeatScale = 1.0 # real seconds per heartbeat second
+        self.connectTimeout = 2.0
+        self.events = queue.Queue()
+        self.log = []
+        self.listeners = []
+        self.deviceWrites = 0
+        self.bytesSent = 0
+        self.bytesReceived = 0
+        self.plugin = None
+        self.folder = '.'
+
+    def Load(self, path):
+        self.folder = os.path.dirname(os.path.abspath(path))
+        sys.modules['Domoticz'] = sys.modules[__name__]
+        # Domoticz puts the plugin folder on the path for the plugin's own modules
+        if self.folder not in sys.path:
+            sys.path.insert(0, self.folder)
+        spec = importlib.util.spec_from_file_location('plugin', path)
+        self.plugin = importlib.util.module_from_spec(spec)
+        self.plugin.Parameters = self.Parameters
+        self.plugin.Devices = self.Devices
+        self.plugin.Images = self.Images
+        spec.loader.exec_module(self.plugin)
+        return self.plugin
+
+    def Output(self, level, message):
+        entry = (time.monotonic(), level, message)
+        self.log.append(entry)
+        for listener in self.listeners:
+            listener(entry)
+        if self.verbose:
+            print('%-6s %s' % (level, message))
+
+    def Post(self, function, *args):
+        self.events.put((function, args))
+
+    def Callback(self, name, *args):
+        getattr(self.plugin, name)(*args)
+
+    def Start(self):
+        self.nextHeartbeat = time.monotonic() + self.heartbeat * self.heartbeatScale
+        self.plugin.onStart()
+
+    def Stop(self):
+        self.plugin.onStop()
+
+    def Run(self, seconds, until=None):
+        # Deliver callbacks and heartbeats for up to seconds, or until until() is true
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            if (until is not None) and until():
+                return True
+            timeout = max(0.0, min(deadline, self.nextHeartbeat) - time.monotonic())
+            try:
+                (function, args) = self.events.get(timeout=timeout)
+                function(*args)
+            except queue.Empty:
+                pass
+            if time.monotonic() >= self.nextHeartbeat:
+                self.nextHeartbeat = time.monotonic() + self.heartbeat * self.heartbeatScale
+                self.plugin.onHeartbeat()
+        return (until is not None) and until()
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+#
+# Offline stand-in for an Atag One thermostat
+#
+# Speaks the local JSON API on /retrieve, /pair_message and /update so the
+# plugin can be exercised without the real thermostat. Pairing flow, latency,
+# dropped replies and malformed JSON can be injected from the command line
+# or by changing the attributes of a running AtagOneSimulator; Fail() breaks
+# the next reply to one path on purpose. Like the real
+# one it can announce itself with 'ONE <device id>' UDP broadcasts.
+#
+import argparse
+import json
+import random
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_PORT = 10000
+DISCOVERY_PORT = 11000
+
+
+class AtagOneSimulator:
+    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT, pairing='2', latency=0.0, dropRate=0.0, malformedRate=0.0, seed=None):
+        # pairing: acc_status values returned by successive pair/retrieve calls
+        # until authorized, e.g. '1,1,2' = pending twice then accepted
+        self.host = host
+        self.port = port
+        self.pairing = [int(status) for status in str(pairing).split(',') if status.strip() != '']
+        self.latency = latency
+        self.dropRate = dropRate
+        self.malformedRate = malformedRate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = {'/retrieve': 0, '/pair_message': 0, '/update': 0}
+        self.control = {'ch_mode_temp': 20.0, 'ch_mode': 1, 'ch_status': 1, 'dhw_temp_setp': 50.0, 'dhw_status': 1, 'vacation_duration': 0}
+        self.report = {'room_temp': 19.5, 'outside_temp': 8.0, 'burning_hours': 1234, 'ch_setpoint': 40.0,
+                       'dhw_water_temp': 48.0, 'ch_water_temp': 38.0, 'ch_water_pres': 1.6, 'ch_return_temp': 32.0,
+                       'boiler_status': 0, 'details': {'rel_mod_level': 0}}
+        self.configuration = {'dhw_min_set': 40, 'dhw_max_set': 65, 'temp_unit': 0}
+        self.schedules = {'ch_schedule': {'repeated': True, 'entries': [[6, 30, 20.0], [22, 30, 16.0]]}}
+        self.status = {'device_id': '6808-1401-3109_15-30-001-544', 'device_status': 16385}
+        self.server = None
+        self.thread = None
+        self.announcing = threading.Event()
+        self.connections = set()
+        self.faults = [] # (path, fault) for the next replies, see Fail()
+
+    def Fail(self, path, fault):
+        # Break the next reply to path: 'truncate' the JSON, answer with HTTP 'status' 500
+        # or with 'acc_error' (acc_status 0, no sections)
+        with self.lock:
+            self.faults.append((path, fault))
+        return self
+
+    def Fault(self, path):
+        with self.lock:
+            for entry in self.faults:
+                if entry[0] == path:
+                    self.faults.remove(entry)
+                    return entry[1]
+        return None
+
+    def AccStatus(self):
+        with self.lock:
+            if len(self.pairing) > 1:
+                return self.pairing.pop(0)
+            return self.pairing[0] if self.pairing else 2
+
+    def Step(self):
+        # Let the readings wander a little, the flame follows the setpoint
+        with self.lock:
+            report = self.report
+            heating = report['room_temp'] < self.control['ch_mode_temp']
+            report['boiler_status'] = 8 if heating else 0
+            report['details']['rel_mod_level'] = self.random.randint(20, 80) if heating else 0
+            report['room_temp'] = round(report['room_temp'] + (0.1 if heating else -0.05) * self.random.random(), 1)
+            report['ch_water_temp'] = round(report['ch_water_temp'] + self.random.uniform(-0.2, 0.2), 1)
+            report['ch_return_temp'] = round(report['ch_return_temp'] + self.random.uniform(-0.2, 0.2), 1)
+            report['ch_water_pres'] = round(report['ch_water_pres'] + self.random.uniform(-0.01, 0.01), 2)
+
+    def Reply(self, path, message):
+        seqnr = message.get('seqnr', 0)
+        if path == '/pair_message':
+            return {'pair_reply': {'seqnr': seqnr, 'acc_status': self.AccStatus()}}
+        if path == '/update':
+            with self.lock:
+                for key in message.get('control', {}):
+                    self.control[key] = message['control'][key]
+                for key in message.get('configuration', {}):
+                    self.configuration[key] = message['configuration'][key]
+            return {'update_reply': {'seqnr': seqnr, 'acc_status': 2, 'status': {'device_status': 16385}}}
+        accStatus = self.AccStatus()
+        reply = {'seqnr': seqnr, 'acc_status': accStatus}
+        if accStatus == 2:
+            self.Step()
+            info = int(message.get('info', 0))
+            with self.lock:
+                for (bit, name, section) in ((1, 'control', self.control), (2, 'schedules', self.schedules),
+                                             (4, 'configuration', self.configuration), (8, 'report', self.report),
+                                             (16, 'status', self.status)):
+                    if info & bit:
+                        reply[name] = json.loads(json.dumps(section))
+        return {'retrieve_reply': reply}
+
+    def Start(self):
+        simulator = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True # headers and body go out in separate writes
+
+            def log_message(self, format, *args):
+                return
+
+            def setup(self):
+                BaseHTTPRequestHandler.setup(self)
+                with simulator.lock:
+                    simulator.connections.add(self.connection)
+
+            def finish(self):
+                with simulator.lock:
+                    simulator.connections.discard(self.connection)
+                BaseHTTPRequestHandler.finish(self)
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = json.loads(self.rfile.read(length) or b'{}')
+                if self.path not in simulator.requests:
+                    self.send_error(404)
+                    return
+                with simulator.lock:
+                    simulator.requests[self.path] += 1
+                message = body[list(body)[0]] if body else {}
+                if simulator.latency > 0:
+                    time.sleep(simulator.latency)
+                if simulator.random.random() < simulator.dropRate:
+                    # Swallow the request and hang up, like a thermostat dropping off Wi-Fi
+                    self.close_connection = True
+                    self.connection.shutdown(socket.SHUT_RDWR)
+                    return
+                reply = simulator.Reply(self.path, message)
+                fault = simulator.Fault(self.path)
+                if fault == 'acc_error':
+                    reply = dict([(name, {'seqnr': message.get('seqnr', 0), 'acc_status': 0}) for name in reply])
+                data = json.dumps(reply).encode('utf-8')
+                if (simulator.random.random() < simulator.malformedRate) or (fault == 'truncate'):
+                    data = data[:len(data) // 2]
+                self.send_response(500 if fault == 'status' else 200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def Announce(self, address='255.255.255.255', port=DISCOVERY_PORT):
+        # One announcement, sent from the simulator's own address
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            sock.bind((self.host, 0))
+            sock.sendto(('ONE %s' % self.status['device_id']).encode('ascii'), (address, port))
+
+    def StartAnnouncing(self, interval, address='255.255.255.255', port=DISCOVERY_PORT):
+        def Loop():
+            while not self.announcing.wait(interval):
+                try:
+                    self.Announce(address, port)
+                except OSError:
+                    pass
+        self.announcing.clear()
+        threading.Thread(target=Loop, daemon=True).start()
+        return self
+
+    def Stop(self):
+        self.announcing.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        # Hang up kept-alive connections too, as a thermostat leaving the network would
+        with self.lock:
+            for connection in self.connections:
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Atag One thermostat simulator')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--pairing', default='2', help='acc_status sequence until paired, e.g. 3,1,2')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every reply')
+    parser.add_argument('--drop', type=float, default=0.0, help='fraction of requests answered by hanging up')
+    parser.add_argument('--malformed', type=float, default=0.0, help='fraction of replies with truncated JSON')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--announce', type=float, default=0.0, help='seconds between discovery broadcasts, 0 = off')
+    parser.add_argument('--announce-to', default='255.255.255.255:%d' % DISCOVERY_PORT, help='address:port for the broadcasts')
+    args = parser.parse_args()
+    simulator = AtagOneSimulator(args.host, args.port, args.pairing, args.latency, args.drop, args.malformed, args.seed).Start()
+    if args.announce > 0:
+        (address, port) = args.announce_to.rsplit(':', 1)
+        simulator.StartAnnouncing(args.announce, address, int(port))
+    print('Atag One simulator listening on %s:%d' % (simulator.host, simulator.port))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        simulator.Stop()
+
+
+if __name__ == '__main__':
+    main()
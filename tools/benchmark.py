@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+#
+# Benchmarks for plugin.py against the Atag One simulator
+#
+# Runs the plugin under the mock Domoticz runtime and reports:
+#   throughput  - replies/s through onMessage -> ProcessDetails -> UpdateDevice
+#   recovery    - time from the thermostat coming back to the next good poll
+#   confirm     - onCommand to confirmed read-back of a new setpoint
+#   failover    - thermostat moving to another IP to the first good poll there,
+#                 found through its UDP announcements
+#   stagger     - spacing of polls across several thermostats
+#   faults      - a setpoint change whose /update or read-back reply is broken
+#                 must not wedge the command queue; the next change goes out
+#
+# Plugin timings are scaled down (--scale) so a run takes seconds, not hours;
+# recovery times are in scaled time, divide by the scale for the real figure.
+#
+import argparse
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+
+TOOLS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, TOOLS)
+
+import Domoticz
+from atagone_sim import AtagOneSimulator
+
+PLUGIN = os.path.join(os.path.dirname(TOOLS), 'plugin.py')
+TIMINGS = ('POLL_INTERVAL_FAST', 'POLL_INTERVAL_BASE', 'POLL_INTERVAL_MAX', 'RETRY_INTERVAL_MIN', 'RETRY_INTERVAL_MAX',
+           'REQUEST_TIMEOUT')
+
+
+def FreePort(kind=socket.SOCK_DGRAM):
+    with socket.socket(socket.AF_INET, kind) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def Percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {}
+    pick = lambda percent: samples[min(len(samples) - 1, int(len(samples) * percent / 100.0))]
+    return {'n': len(samples), 'p50': round(pick(50), 2), 'p95': round(pick(95), 2), 'max': round(samples[-1], 2)}
+
+
+class Bench:
+    def __init__(self, port, scale, verbose=False):
+        self.folder = tempfile.mkdtemp(prefix='atagone-bench-')
+        self.runtime = Domoticz.Runtime({'Address': '127.0.0.1', 'Port': str(port), 'Mode1': '1A-2B-3C-4D-5E-6F',
+                                         'Mode2': 'Normal', 'Mode3': '0', 'Mode4': 'Off', 'Mode5': '', 'Mode6': '',
+                                         'HomeFolder': self.folder + os.sep, 'Key': 'AtagOneOnPremise',
+                                         'HardwareID': 1, 'Name': 'Atag One'}, verbose)
+        self.runtime.heartbeatScale = scale
+        self.module = self.runtime.Load(PLUGIN)
+        self.plugin = self.module._plugin
+        self.plugin.HTTP_CLIENT_PORT = str(port)
+        self.plugin.DISCOVERY_PORT = str(FreePort())
+        for name in TIMINGS:
+            setattr(self.plugin, name, getattr(self.plugin, name) * scale)
+        self.plugin.shadow.minInterval *= scale
+        self.plugin.shadow.refreshInterval *= scale
+        # Count completed polls without touching the plugin's own bookkeeping
+        self.polls = 0
+        self.pollTimes = []
+        processDetails = self.module.Thermostat.ProcessDetails
+
+        def CountingProcessDetails(thermostat, response, *args):
+            self.polls += 1
+            self.pollTimes.append((time.monotonic(), thermostat.index))
+            return processDetails(thermostat, response, *args)
+        self.module.Thermostat.ProcessDetails = CountingProcessDetails
+
+    def Start(self, timeout):
+        self.runtime.Start()
+        self.thermostat = self.plugin.thermostats[0]
+        if not self.runtime.Run(timeout, lambda: self.polls > 0):
+            raise RuntimeError('plugin did not complete a first poll')
+
+    def Stop(self):
+        self.runtime.Stop()
+
+
+def Throughput(count, split=100):
+    # No network involved, replies are fed straight into onMessage
+    bench = Bench(1, 1.0)
+    bench.runtime.Start()
+    thermostat = bench.plugin.thermostats[0]
+    thermostat.requestQueue = []
+    connection = Domoticz.Connection(thermostat.connName, Address=thermostat.address)
+    simulator = AtagOneSimulator(seed=1)
+    writes = bench.runtime.deviceWrites
+    started = time.perf_counter()
+    for seqnr in range(1, count + 1):
+        body = json.dumps(simulator.Reply('/retrieve', {'seqnr': seqnr, 'info': 15})).encode('utf-8')
+        data = b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n' % len(body) + body
+        thermostat.tracker.Sent(seqnr, {'URL': '/retrieve'}, 0)
+        thermostat.connState = thermostat.STATE_BUSY
+        # Split like a reply arriving in two TCP segments
+        bench.module.onMessage(connection, data[:split])
+        bench.module.onMessage(connection, data[split:])
+    elapsed = time.perf_counter() - started
+    return {'messages': count, 'seconds': round(elapsed, 3), 'messages_per_s': round(count / elapsed),
+            'device_writes': bench.runtime.deviceWrites - writes}
+
+
+def Recovery(rounds, outage, scale):
+    simulator = AtagOneSimulator(port=0, seed=2).Start()
+    bench = Bench(simulator.port, scale)
+    bench.Start(5)
+    samples = []
+    try:
+        for round in range(rounds):
+            # Make sure the plugin noticed the outage before timing the way back
+            simulator.dropRate = 1.0
+            bench.runtime.Run(60 * scale, lambda: bench.thermostat.scheduler.failures > 0)
+            bench.runtime.Run(outage)
+            simulator.dropRate = 0.0
+            polls = bench.polls
+            restored = time.monotonic()
+            if bench.runtime.Run(60 * scale, lambda: bench.polls > polls):
+                samples.append((time.monotonic() - restored) * 1000)
+    finally:
+        bench.Stop()
+        simulator.Stop()
+    return {'recovery_ms': Percentiles(samples), 'connects': bench.plugin.stats.counters['connects']}
+
+
+def Confirm(rounds, latency, scale):
+    simulator = AtagOneSimulator(port=0, latency=latency, seed=3).Start()
+    bench = Bench(simulator.port, scale)
+    bench.Start(5)
+    confirmed = []
+    bench.runtime.listeners.append(lambda entry: confirmed.append(entry) if 'confirmed' in entry[2] else None)
+    samples = []
+    try:
+        for round in range(rounds):
+            target = 18.0 + (round % 8) * 0.5
+            count = len(confirmed)
+            started = time.monotonic()
+            bench.module.onCommand(bench.plugin.TARGET_TEMP_UNIT, 'Set Level', target, 0)
+            if bench.runtime.Run(10, lambda: len(confirmed) > count):
+                samples.append((time.monotonic() - started) * 1000)
+    finally:
+        bench.Stop()
+        simulator.Stop()
+    return {'write_to_confirm_ms': Percentiles(samples), 'updates_sent': simulator.requests['/update']}
+
+
+def Failover(rounds, scale):
+    # The thermostat hops between 127.0.0.1 and 127.0.0.2 on the same port,
+    # announcing itself every (scaled) 5 seconds from wherever it is
+    port = FreePort(socket.SOCK_STREAM)
+    simulator = AtagOneSimulator(port=port, seed=4).Start()
+    bench = Bench(port, scale)
+    bench.Start(5)
+    discovery = int(bench.plugin.DISCOVERY_PORT)
+    simulator.StartAnnouncing(5 * scale, '127.0.0.1', discovery)
+    samples = []
+    try:
+        for round in range(rounds):
+            simulator.Stop()
+            simulator = AtagOneSimulator(host='127.0.0.%d' % (2 - round % 2), port=port, seed=4).Start()
+            polls = bench.polls
+            moved = time.monotonic()
+            simulator.StartAnnouncing(5 * scale, '127.0.0.1', discovery)
+            if bench.runtime.Run(120 * scale, lambda: (bench.polls > polls) and (bench.thermostat.address == simulator.host)):
+                samples.append((time.monotonic() - moved) * 1000)
+    finally:
+        bench.Stop()
+        simulator.Stop()
+    return {'failover_ms': Percentiles(samples), 'connects': bench.plugin.stats.counters['connects']}
+
+
+def Stagger(count, rounds, scale):
+    # One plugin instance polling several simulators on 127.0.0.1, .2, ...;
+    # reports how far apart polls of different thermostats complete
+    port = FreePort(socket.SOCK_STREAM)
+    simulators = [AtagOneSimulator(host='127.0.0.%d' % (index + 1), port=port, seed=index).Start() for index in range(count)]
+    bench = Bench(port, scale)
+    bench.runtime.Parameters['Address'] = ','.join([simulator.host for simulator in simulators])
+    bench.Start(5)
+    try:
+        bench.runtime.Run(rounds * bench.plugin.POLL_INTERVAL_MAX)
+    finally:
+        bench.Stop()
+        for simulator in simulators:
+            simulator.Stop()
+    gaps = [(later[0] - earlier[0]) * 1000 for (earlier, later) in zip(bench.pollTimes, bench.pollTimes[1:]) if earlier[1] != later[1]]
+    polls = [len([poll for poll in bench.pollTimes if poll[1] == index]) for index in range(count)]
+    return {'polls': polls, 'gap_ms': Percentiles(gaps), 'heartbeat_ms': round(bench.plugin.HEARTBEAT_INTERVAL * scale * 1000),
+            'devices': len(bench.runtime.Devices)}
+
+
+def Faults(scale):
+    # Each case breaks one reply a setpoint change waits on, then checks a second
+    # change is still sent and confirmed
+    cases = (('/update', 'truncate'), ('/update', 'status'), ('/retrieve', 'truncate'), ('/retrieve', 'status'),
+             ('/retrieve', 'acc_error'))
+    simulator = AtagOneSimulator(port=0, seed=6).Start()
+    bench = Bench(simulator.port, scale)
+    bench.Start(5)
+    confirmed = []
+    bench.runtime.listeners.append(lambda entry: confirmed.append(entry) if 'confirmed' in entry[2] else None)
+    recovered = []
+    try:
+        for (index, (path, fault)) in enumerate(cases):
+            bench.runtime.Run(1, lambda: not bench.thermostat.commands.Busy())
+            simulator.Fail(path, fault) # for a retrieve, the read-back right after the /update
+            bench.module.onCommand(bench.plugin.TARGET_TEMP_UNIT, 'Set Level', 18.0 + index, 0)
+            bench.runtime.Run(2, lambda: (len(simulator.faults) == 0) and (not bench.thermostat.commands.Busy()))
+            count = len(confirmed)
+            bench.module.onCommand(bench.plugin.TARGET_TEMP_UNIT, 'Set Level', 24.0 - index, 0)
+            if bench.runtime.Run(5, lambda: len(confirmed) > count):
+                recovered.append('%s %s' % (path, fault))
+    finally:
+        bench.Stop()
+        simulator.Stop()
+    return {'recovered': '%d/%d' % (len(recovered), len(cases)), 'stuck': [case for case in ['%s %s' % case for case in cases] if case not in recovered]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark plugin.py against the Atag One simulator')
+    parser.add_argument('--messages', type=int, default=5000, help='replies for the throughput run')
+    parser.add_argument('--rounds', type=int, default=5, help='outages / setpoint changes to measure')
+    parser.add_argument('--outage', type=float, default=1.0, help='seconds the thermostat drops every request')
+    parser.add_argument('--latency', type=float, default=0.02, help='simulated thermostat reply latency')
+    parser.add_argument('--scale', type=float, default=0.02, help='plugin timing scale, 0.02 = 10s heartbeat in 0.2s')
+    parser.add_argument('--thermostats', type=int, default=3, help='simulators for the stagger run')
+    parser.add_argument('--only', choices=('throughput', 'recovery', 'confirm', 'failover', 'stagger', 'faults'))
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    results = {}
+    if args.only in (None, 'throughput'):
+        results['throughput'] = Throughput(args.messages)
+    if args.only in (None, 'recovery'):
+        results['recovery'] = Recovery(args.rounds, args.outage, args.scale)
+    if args.only in (None, 'confirm'):
+        results['confirm'] = Confirm(args.rounds, args.latency, args.scale)
+    if args.only in (None, 'failover'):
+        results['failover'] = Failover(args.rounds, args.scale)
+    if args.only in (None, 'stagger'):
+        results['stagger'] = Stagger(args.thermostats, args.rounds, args.scale)
+    if args.only in (None, 'faults'):
+        results['faults'] = Faults(args.scale)
+    if args.json:
+        print(json.dumps(results, indent=1))
+    else:
+        for name in results:
+            print('%-10s %s' % (name, ', '.join('%s=%s' % (key, results[name][key]) for key in results[name])))
+
+
+if __name__ == '__main__':
+    main()